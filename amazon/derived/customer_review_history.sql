@@ -0,0 +1,54 @@
+-- Running per-customer review statistics, one row per (customer, review time). ASOF joining on
+-- `ts > review_time` gives the customer's features as of any point in time ts.
+create or replace table customer_review_history as -- noqa
+
+with reviews_by_time as (
+    select
+        review.customer_id,
+        review.review_time,
+        count(*) as num_reviews,
+        count(product.price) as num_prices,
+        sum(product.price) as total_spent,
+        count(review.rating) as num_ratings,
+        sum(review.rating) as sum_ratings,
+        sum(review.rating * review.rating) as sum_sq_ratings
+    from review
+    left join product
+        on review.product_id = product.product_id
+    group by review.customer_id, review.review_time
+),
+
+running as (
+    select
+        customer_id,
+        review_time,
+        sum(num_reviews) over running_total as num_reviews,
+        sum(num_prices) over running_total as num_prices,
+        sum(total_spent) over running_total as total_spent,
+        sum(num_ratings) over running_total as num_ratings,
+        sum(sum_ratings) over running_total as sum_ratings,
+        sum(sum_sq_ratings) over running_total as sum_sq_ratings
+    from reviews_by_time
+    window running_total as (
+        partition by customer_id
+        order by review_time asc
+        rows between unbounded preceding and current row
+    )
+)
+
+select
+    customer_id,
+    review_time,
+    num_reviews,
+    total_spent,
+    total_spent / nullif(num_prices, 0) as avg_price,
+    sum_ratings / nullif(num_ratings, 0) as avg_rating,
+    -- sample stddev from running moments (matches stddev(), which is null for a single rating)
+    case
+        when num_ratings > 1 then sqrt(
+            greatest(sum_sq_ratings - sum_ratings * sum_ratings / num_ratings, 0)
+            / (num_ratings - 1)
+        )
+    end as std_rating
+from running
+order by customer_id, review_time
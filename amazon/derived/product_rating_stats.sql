@@ -0,0 +1,138 @@
+-- Global product rating statistics as of every label timestamp of the item tasks: for each window of
+-- months before the timestamp, the mean and stddev over all products rated in the window of their
+-- average rating in the window. feats.sql normalizes product ratings with these (product_bias) by
+-- joining on (timestamp, lb, ub), instead of with windows over all label rows (`over ()`), which
+-- needed extra passes over the labels and mixed in the ratings of other label timestamps.
+create or replace table product_rating_stats as -- noqa
+
+with timestamps as (
+    select timestamp from item_churn_train_timestamps
+    union
+    select timestamp from item_churn_val_timestamps
+    union
+    select timestamp from item_churn_test_timestamps
+    union
+    select timestamp from item_ltv_train_timestamps
+    union
+    select timestamp from item_ltv_val_timestamps
+    union
+    select timestamp from item_ltv_test_timestamps
+),
+
+-- reviews with timestamp - ub months <= review_time < timestamp - lb months (ub null for all time),
+-- or timestamp - ub months < review_time if not ub_inclusive. These are the exact windows of the
+-- item-ltv (inclusive) and item-churn trend (exclusive) feats.sql
+windows as (
+    select *
+    from (
+        values
+        (0, null, true),
+        (0, 3, true),
+        (3, 6, true),
+        (6, 9, true),
+        (0, 6, false),
+        (6, 12, false)
+    ) as windows (lb, ub, ub_inclusive)
+),
+
+bounds as (
+    select lb as months from windows
+    union
+    select ub as months from windows where ub is not null
+),
+
+running as (
+    select
+        product_id,
+        review_time,
+        sum(count(rating)) over running_total as num_ratings,
+        sum(sum(rating)) over running_total as sum_ratings
+    from review
+    group by product_id, review_time
+    window running_total as (
+        partition by product_id
+        order by review_time asc
+        rows between unbounded preceding and current row
+    )
+),
+
+probes as (
+    select
+        first_reviews.product_id,
+        timestamps.timestamp,
+        bounds.months
+    from (
+        select
+            product_id,
+            min(review_time) as first_review_time
+        from review
+        group by product_id
+    ) as first_reviews
+    inner join timestamps
+        on first_reviews.first_review_time < timestamps.timestamp
+    cross join bounds
+),
+
+-- ratings of each product strictly before (num_ratings, sum_ratings) and at or before
+-- (num_ratings_incl, sum_ratings_incl) timestamp - months, for every bound of every window
+cumulative as (
+    select
+        before.product_id,
+        before.timestamp,
+        before.months,
+        before.num_ratings,
+        before.sum_ratings,
+        coalesce(running_incl.num_ratings, 0) as num_ratings_incl,
+        coalesce(running_incl.sum_ratings, 0) as sum_ratings_incl
+    from (
+        select
+            probes.product_id,
+            probes.timestamp,
+            probes.months,
+            coalesce(running.num_ratings, 0) as num_ratings,
+            coalesce(running.sum_ratings, 0) as sum_ratings
+        from probes
+        asof left join running
+            on
+                probes.product_id = running.product_id
+                and probes.timestamp - to_months(probes.months) > running.review_time
+    ) as before
+    asof left join running as running_incl
+        on
+            before.product_id = running_incl.product_id
+            and before.timestamp - to_months(before.months) >= running_incl.review_time
+),
+
+product_window_ratings as (
+    select
+        upper_bound.timestamp,
+        windows.lb,
+        windows.ub,
+        windows.ub_inclusive,
+        upper_bound.num_ratings - coalesce(if(
+            windows.ub_inclusive, lower_bound.num_ratings, lower_bound.num_ratings_incl
+        ), 0) as num_ratings,
+        upper_bound.sum_ratings - coalesce(if(
+            windows.ub_inclusive, lower_bound.sum_ratings, lower_bound.sum_ratings_incl
+        ), 0) as sum_ratings
+    from windows
+    inner join cumulative as upper_bound
+        on windows.lb = upper_bound.months
+    left join cumulative as lower_bound
+        on
+            upper_bound.product_id = lower_bound.product_id
+            and upper_bound.timestamp = lower_bound.timestamp
+            and windows.ub = lower_bound.months
+)
+
+select
+    timestamp,
+    lb,
+    ub,
+    ub_inclusive,
+    avg(sum_ratings / num_ratings) as mean_avg_rating,
+    stddev(sum_ratings / num_ratings) as std_avg_rating
+from product_window_ratings
+where num_ratings > 0
+group by timestamp, lb, ub, ub_inclusive
+order by timestamp, lb, ub
@@ -28,9 +28,7 @@ product_feats as (
         max(review.rating) as max_rating,
         avg(review.verified::int) as pct_verified_reviews,
         avg(length(review.review_text)) as avg_review_length,
-        arg_max(review.summary, review.review_time) as last_review_summary,
-        -- Using avg of avg rating as a proxy for global avg rating
-        (avg_rating - avg(avg_rating) over ()) / stddev(avg_rating) over () as product_bias
+        arg_max(review.summary, review.review_time) as last_review_summary
     from labels
     left join product
         on labels.product_id = product.product_id
@@ -92,8 +90,7 @@ last_6mo as (
         sum(review.rating) as sum_ratings,
         min(review.rating) as min_rating,
         max(review.rating) as max_rating,
-        avg(length(review.review_text)) as avg_review_length,
-        (avg_rating - avg(avg_rating) over ()) / stddev(avg_rating) over () as product_bias
+        avg(length(review.review_text)) as avg_review_length
     from labels
     left join review
         on
@@ -112,8 +109,7 @@ prev_6mo as (
         sum(review.rating) as sum_ratings,
         min(review.rating) as min_rating,
         max(review.rating) as max_rating,
-        avg(length(review.review_text)) as avg_review_length,
-        (avg_rating - avg(avg_rating) over ()) / stddev(avg_rating) over () as product_bias
+        avg(length(review.review_text)) as avg_review_length
     from labels
     left join review
         on
@@ -133,7 +129,10 @@ trends as (
         (last_6mo.min_rating - prev_6mo.min_rating) as min_rating_trend,
         (last_6mo.max_rating - prev_6mo.max_rating) as max_rating_trend,
         (last_6mo.avg_review_length - prev_6mo.avg_review_length) as avg_review_length_trend,
-        (last_6mo.product_bias - prev_6mo.product_bias) as product_bias_trend
+        (
+            (last_6mo.avg_rating - last_6mo_stats.mean_avg_rating) / last_6mo_stats.std_avg_rating
+            - (prev_6mo.avg_rating - prev_6mo_stats.mean_avg_rating) / prev_6mo_stats.std_avg_rating
+        ) as product_bias_trend
     from labels
     left join last_6mo
         on
@@ -143,6 +142,18 @@ trends as (
         on
             labels.product_id = prev_6mo.product_id
             and labels.timestamp = prev_6mo.timestamp
+    left join product_rating_stats as last_6mo_stats
+        on
+            labels.timestamp = last_6mo_stats.timestamp
+            and last_6mo_stats.lb = 0
+            and last_6mo_stats.ub = 6
+            and not last_6mo_stats.ub_inclusive
+    left join product_rating_stats as prev_6mo_stats
+        on
+            labels.timestamp = prev_6mo_stats.timestamp
+            and prev_6mo_stats.lb = 6
+            and prev_6mo_stats.ub = 12
+            and not prev_6mo_stats.ub_inclusive
 )
 
 select
@@ -166,7 +177,10 @@ select
     product_feats.pct_verified_reviews,
     product_feats.avg_review_length,
     product_feats.last_review_summary,
-    product_feats.product_bias,
+    -- product rating relative to all products rated before the timestamp (see
+    -- amazon/derived/product_rating_stats.sql)
+    (product_feats.avg_rating - all_time_stats.mean_avg_rating)
+    / all_time_stats.std_avg_rating as product_bias,
     reviewer_aggs.avg_reviewer_num_reviews,
     reviewer_aggs.avg_reviewer_total_spent,
     reviewer_aggs.avg_reviewer_avg_price,
@@ -192,3 +206,8 @@ left join trends
     on
         labels.product_id = trends.product_id
         and labels.timestamp = trends.timestamp
+left join product_rating_stats as all_time_stats
+    on
+        labels.timestamp = all_time_stats.timestamp
+        and all_time_stats.lb = 0
+        and all_time_stats.ub is null
@@ -1,3 +1,5 @@
+{% from 'macros.sql' import window_aggs %}
+{% set windows = [(0, 3), (3, 6), (6, 9)] %}
 create or replace table item_ltv_{{ set }}_feats as -- noqa
 
 with labels as materialized (
@@ -8,63 +10,53 @@ with labels as materialized (
     {% endif %}
 ),
 
-timestamps as (
-    select distinct timestamp from labels
-),
-
-customer_feats as (
+-- one pass over review for all windows (see macros.sql)
+window_feats as (
     select
-        timestamps.timestamp,
-        review.customer_id,
-        count(*) as num_reviews,
-        sum(product.price) as total_spent,
-        avg(product.price) as avg_price,
-        avg(review.rating) as avg_rating,
-        stddev(review.rating) as std_rating
-    from timestamps
+        labels.product_id,
+        labels.timestamp,
+        {{ window_aggs(
+            [
+                ('num_reviews', 'greatest(count(*) {filter}, 1)'),
+                ('sum_ratings', 'sum(review.rating) {filter}'),
+                ('avg_rating', 'avg(review.rating) {filter}'),
+                ('std_rating', 'stddev(review.rating) {filter}'),
+                ('min_rating', 'min(review.rating) {filter}'),
+                ('max_rating', 'max(review.rating) {filter}'),
+                ('avg_review_length', 'avg(length(review.review_text)) {filter}'),
+                ('pct_verified_reviews', 'avg(review.verified::int) {filter}'),
+                ('avg_reviewer_num_reviews', 'avg(reviewer.num_reviews) {filter}'),
+                ('avg_reviewer_total_spent', 'avg(reviewer.total_spent) {filter}'),
+                ('avg_reviewer_avg_price', 'avg(reviewer.avg_price) {filter}'),
+                ('avg_reviewer_avg_rating', 'avg(reviewer.avg_rating) {filter}'),
+                ('avg_reviewer_std_rating', 'avg(reviewer.std_rating) {filter}'),
+            ],
+            windows,
+            ('lb', 'ub'),
+            "labels.timestamp - interval '{lb} months' > review.review_time "
+            ~ "and labels.timestamp - interval '{ub} months' <= review.review_time",
+            '{lb}_to_{ub}',
+        ) }}
+    from labels
     left join review
-        on timestamps.timestamp > review.review_time
-    left join product
-        on review.product_id = product.product_id
-    group by all
+        on
+            labels.product_id = review.product_id
+            and labels.timestamp - interval '{{ windows[0][0] }} months' > review.review_time
+            and labels.timestamp - interval '{{ windows[-1][1] }} months' <= review.review_time
+    -- reviewer aggs: customer features as of the end date of the review's window, looked up in
+    -- the precomputed running history (see amazon/derived/customer_review_history.sql)
+    asof left join customer_review_history as reviewer
+        on
+            review.customer_id = reviewer.customer_id
+            and case
+                {% for lb, ub in windows %}
+                    when labels.timestamp - interval '{{ ub }} months' <= review.review_time
+                        then labels.timestamp - interval '{{ lb }} months'
+                {% endfor %}
+            end > reviewer.review_time
+    group by labels.product_id, labels.timestamp
 ),
 
-{% for lb, ub in [(0, 3), (3, 6), (6, 9)] %}
-    window_feats_{{ lb }}_to_{{ ub }} as (
-        select
-            labels.product_id,
-            labels.timestamp,
-            count(*) as num_reviews_{{ lb }}_to_{{ ub }},
-            sum(review.rating) as sum_ratings_{{ lb }}_to_{{ ub }},
-            avg(review.rating) as avg_rating_{{ lb }}_to_{{ ub }},
-            stddev(review.rating) as std_rating_{{ lb }}_to_{{ ub }},
-            min(review.rating) as min_rating_{{ lb }}_to_{{ ub }},
-            max(review.rating) as max_rating_{{ lb }}_to_{{ ub }},
-            avg(length(review.review_text)) as avg_review_length_{{ lb }}_to_{{ ub }},
-            avg(review.verified::int) as pct_verified_reviews_{{ lb }}_to_{{ ub }},
-            (avg(review.rating) - avg(avg(review.rating)) over ())
-            / stddev(avg(review.rating)) over () as product_bias_{{ lb }}_to_{{ ub }},
-            -- reviewer aggs: too slow to compute customer features as of window end date so using
-            -- features as of timestamp (should be close enough)
-            avg(customer_feats.num_reviews) as avg_reviewer_num_reviews_{{ lb }}_to_{{ ub }},
-            avg(customer_feats.total_spent) as avg_reviewer_total_spent_{{ lb }}_to_{{ ub }},
-            avg(customer_feats.avg_price) as avg_reviewer_avg_price_{{ lb }}_to_{{ ub }},
-            avg(customer_feats.avg_rating) as avg_reviewer_avg_rating_{{ lb }}_to_{{ ub }},
-            avg(customer_feats.std_rating) as avg_reviewer_std_rating_{{ lb }}_to_{{ ub }}
-        from labels
-        left join review
-            on
-                labels.product_id = review.product_id
-                and labels.timestamp - interval '{{ lb }} months' > review.review_time
-                and labels.timestamp - interval '{{ ub }} months' <= review.review_time
-        left join customer_feats
-            on
-                review.customer_id = customer_feats.customer_id
-                and labels.timestamp = customer_feats.timestamp
-        group by labels.product_id, labels.timestamp
-    ),
-{% endfor %}
-
 -- TODO issue is in this table!
 all_time_feats as (
     select
@@ -85,22 +77,20 @@ all_time_feats as (
         max(review.rating) as max_rating,
         avg(length(review.review_text)) as avg_review_length,
         avg(review.verified::int) as pct_verified_reviews,
-        (avg(review.rating) - avg(avg(review.rating)) over ())
-        / stddev(avg(review.rating)) over () as product_bias,
-        avg(customer_feats.num_reviews) as avg_reviewer_num_reviews,
-        avg(customer_feats.total_spent) as avg_reviewer_total_spent,
-        avg(customer_feats.avg_price) as avg_reviewer_avg_price,
-        avg(customer_feats.avg_rating) as avg_reviewer_avg_rating,
-        avg(customer_feats.std_rating) as avg_reviewer_std_rating
+        avg(reviewer.num_reviews) as avg_reviewer_num_reviews,
+        avg(reviewer.total_spent) as avg_reviewer_total_spent,
+        avg(reviewer.avg_price) as avg_reviewer_avg_price,
+        avg(reviewer.avg_rating) as avg_reviewer_avg_rating,
+        avg(reviewer.std_rating) as avg_reviewer_std_rating
     from labels
     left join review
         on
             labels.product_id = review.product_id
             and labels.timestamp > review.review_time
-    left join customer_feats
+    asof left join customer_review_history as reviewer
         on
-            review.customer_id = customer_feats.customer_id
-            and labels.timestamp = customer_feats.timestamp
+            review.customer_id = reviewer.customer_id
+            and labels.timestamp > reviewer.review_time
     group by labels.product_id, labels.timestamp
 )
 
@@ -113,26 +103,37 @@ select
     {% if set != 'test' +%} -- noqa
         labels.ltv,
     {% endif %}
-    {% for lb, ub in [(0, 3), (3, 6), (6, 9)] %}
-        window_feats_{{ lb }}_to_{{ ub }}.* exclude(product_id, timestamp), -- noqa
+    window_feats.* exclude(product_id, timestamp), -- noqa
+    -- product ratings relative to all products rated in the same window (see
+    -- amazon/derived/product_rating_stats.sql)
+    {% for lb, ub in windows %}
+        (window_feats.avg_rating_{{ lb }}_to_{{ ub }} - stats_{{ lb }}_to_{{ ub }}.mean_avg_rating)
+        / stats_{{ lb }}_to_{{ ub }}.std_avg_rating as product_bias_{{ lb }}_to_{{ ub }},
     {% endfor %}
-    all_time_feats.* exclude (product_id, timestamp) -- noqa
+    all_time_feats.* exclude (product_id, timestamp), -- noqa
+    (all_time_feats.avg_rating - all_time_stats.mean_avg_rating)
+    / all_time_stats.std_avg_rating as product_bias
 from labels
 left join product
     on labels.product_id = product.product_id
-left join window_feats_0_to_3
-    on
-        labels.product_id = window_feats_0_to_3.product_id
-        and labels.timestamp = window_feats_0_to_3.timestamp
-left join window_feats_3_to_6
+left join window_feats
     on
-        labels.product_id = window_feats_3_to_6.product_id
-        and labels.timestamp = window_feats_3_to_6.timestamp
-left join window_feats_6_to_9
-    on
-        labels.product_id = window_feats_6_to_9.product_id
-        and labels.timestamp = window_feats_6_to_9.timestamp
+        labels.product_id = window_feats.product_id
+        and labels.timestamp = window_feats.timestamp
 left join all_time_feats
     on
         labels.product_id = all_time_feats.product_id
         and labels.timestamp = all_time_feats.timestamp
+{% for lb, ub in windows %}
+left join product_rating_stats as stats_{{ lb }}_to_{{ ub }}
+    on
+        labels.timestamp = stats_{{ lb }}_to_{{ ub }}.timestamp
+        and stats_{{ lb }}_to_{{ ub }}.lb = {{ lb }}
+        and stats_{{ lb }}_to_{{ ub }}.ub = {{ ub }}
+        and stats_{{ lb }}_to_{{ ub }}.ub_inclusive
+{% endfor %}
+left join product_rating_stats as all_time_stats
+    on
+        labels.timestamp = all_time_stats.timestamp
+        and all_time_stats.lb = 0
+        and all_time_stats.ub is null
@@ -1,3 +1,5 @@
+{% from 'macros.sql' import window_aggs %}
+{% set windows = [(0, 3), (3, 6), (6, 9)] %}
 create or replace table user_ltv_{{ set }}_feats as -- noqa
 
 with labels as materialized (
@@ -38,43 +40,51 @@ product_feats as (
         on product.product_id = product_ratings.product_id
 ),
 
-{% for lb, ub in [(0, 3), (3, 6), (6, 9)] %}
-    window_feats_{{ lb }}_to_{{ ub }} as (
-        select
-            labels.customer_id,
-            labels.timestamp,
-            count(*) as num_reviews_{{ lb }}_to_{{ ub }},
-            sum(review.rating) as sum_review_ratings_{{ lb }}_to_{{ ub }},
-            avg(length(review.review_text)) as avg_review_length_{{ lb }}_to_{{ ub }},
-            avg(review.rating) as avg_review_rating_{{ lb }}_to_{{ ub }},
-            avg(review.verified::int) as pct_verified_reviews_{{ lb }}_to_{{ ub }},
-            stddev(review.rating) as std_review_rating_{{ lb }}_to_{{ ub }},
-            min(review.rating) as min_review_rating_{{ lb }}_to_{{ ub }},
-            max(review.rating) as max_review_rating_{{ lb }}_to_{{ ub }},
-            avg(product_feats.rating) as avg_reviewed_product_rating_{{ lb }}_to_{{ ub }},
-            sum(product_feats.rating) as sum_reviewed_product_rating_{{ lb }}_to_{{ ub }},
-            stddev(product_feats.rating) as std_reviewed_product_rating_{{ lb }}_to_{{ ub }},
-            min(product_feats.rating) as min_reviewed_product_rating_{{ lb }}_to_{{ ub }},
-            max(product_feats.rating) as max_reviewed_product_rating_{{ lb }}_to_{{ ub }},
-            avg(product_feats.price) as avg_reviewed_product_price_{{ lb }}_to_{{ ub }},
-            sum(product_feats.price) as sum_reviewed_product_price_{{ lb }}_to_{{ ub }},
-            stddev(product_feats.price) as std_reviewed_product_price_{{ lb }}_to_{{ ub }},
-            min(product_feats.price) as min_reviewed_product_price_{{ lb }}_to_{{ ub }},
-            max(product_feats.price) as max_reviewed_product_price_{{ lb }}_to_{{ ub }},
-            mode(product_feats.category) as reviewed_product_modal_category_{{ lb }}_to_{{ ub }}
-        from labels
-        left join review
-            on
-                labels.customer_id = review.customer_id
-                and labels.timestamp - interval '{{ lb }} months' > review.review_time
-                and labels.timestamp - interval '{{ ub }} months' <= review.review_time
-        left join product_feats
-            on
-                review.product_id = product_feats.product_id
-                and labels.timestamp = product_feats.timestamp
-        group by labels.customer_id, labels.timestamp
-    ),
-{% endfor %}
+-- one pass over review for all windows (see macros.sql)
+window_feats as (
+    select
+        labels.customer_id,
+        labels.timestamp,
+        {{ window_aggs(
+            [
+                ('num_reviews', 'greatest(count(*) {filter}, 1)'),
+                ('sum_review_ratings', 'sum(review.rating) {filter}'),
+                ('avg_review_length', 'avg(length(review.review_text)) {filter}'),
+                ('avg_review_rating', 'avg(review.rating) {filter}'),
+                ('pct_verified_reviews', 'avg(review.verified::int) {filter}'),
+                ('std_review_rating', 'stddev(review.rating) {filter}'),
+                ('min_review_rating', 'min(review.rating) {filter}'),
+                ('max_review_rating', 'max(review.rating) {filter}'),
+                ('avg_reviewed_product_rating', 'avg(product_feats.rating) {filter}'),
+                ('sum_reviewed_product_rating', 'sum(product_feats.rating) {filter}'),
+                ('std_reviewed_product_rating', 'stddev(product_feats.rating) {filter}'),
+                ('min_reviewed_product_rating', 'min(product_feats.rating) {filter}'),
+                ('max_reviewed_product_rating', 'max(product_feats.rating) {filter}'),
+                ('avg_reviewed_product_price', 'avg(product_feats.price) {filter}'),
+                ('sum_reviewed_product_price', 'sum(product_feats.price) {filter}'),
+                ('std_reviewed_product_price', 'stddev(product_feats.price) {filter}'),
+                ('min_reviewed_product_price', 'min(product_feats.price) {filter}'),
+                ('max_reviewed_product_price', 'max(product_feats.price) {filter}'),
+                ('reviewed_product_modal_category', 'mode(product_feats.category) {filter}'),
+            ],
+            windows,
+            ('lb', 'ub'),
+            "labels.timestamp - interval '{lb} months' > review.review_time "
+            ~ "and labels.timestamp - interval '{ub} months' <= review.review_time",
+            '{lb}_to_{ub}',
+        ) }}
+    from labels
+    left join review
+        on
+            labels.customer_id = review.customer_id
+            and labels.timestamp - interval '{{ windows[0][0] }} months' > review.review_time
+            and labels.timestamp - interval '{{ windows[-1][1] }} months' <= review.review_time
+    left join product_feats
+        on
+            review.product_id = product_feats.product_id
+            and labels.timestamp = product_feats.timestamp
+    group by labels.customer_id, labels.timestamp
+),
 
 all_time_feats as (
     select
@@ -123,23 +133,13 @@ select
     {% if set != 'test' +%} -- noqa
         labels.ltv,
     {% endif %}
-    {% for lb, ub in [(0, 3), (3, 6), (6, 9)] %}
-        window_feats_{{ lb }}_to_{{ ub }}.* exclude(customer_id, timestamp), -- noqa
-    {% endfor %}
+    window_feats.* exclude(customer_id, timestamp), -- noqa
     all_time_feats.* exclude (customer_id, timestamp) -- noqa
 from labels
-left join window_feats_0_to_3
-    on
-        labels.customer_id = window_feats_0_to_3.customer_id
-        and labels.timestamp = window_feats_0_to_3.timestamp
-left join window_feats_3_to_6
-    on
-        labels.customer_id = window_feats_3_to_6.customer_id
-        and labels.timestamp = window_feats_3_to_6.timestamp
-left join window_feats_6_to_9
+left join window_feats
     on
-        labels.customer_id = window_feats_6_to_9.customer_id
-        and labels.timestamp = window_feats_6_to_9.timestamp
+        labels.customer_id = window_feats.customer_id
+        and labels.timestamp = window_feats.timestamp
 left join all_time_feats
     on
         labels.customer_id = all_time_feats.customer_id
@@ -0,0 +1,114 @@
+import argparse
+import os
+import subprocess
+
+import duckdb
+import sqlglot
+from sqlglot import exp
+
+from prune_feats import time_query
+from train_gbdt import DATASET_TO_DB, TASK_PARAMS
+import utils
+
+
+def read_template(path, revision=None):
+    """ Reads a feats.sql template from the working tree, or from a git revision if given. """
+    if revision is None:
+        with open(path) as f:
+            return f.read()
+    return subprocess.run(
+        ['git', 'show', f'{revision}:{path}'], capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    ).stdout
+
+
+def seed_samples(query, seed=0):
+    """ Makes the `using sample` clauses of a rendered query repeatable, so that two runs of it
+    (eg: an exact and an approximate one) subsample the same labels. """
+    tree = sqlglot.parse_one(query, read='duckdb')
+    for sample in tree.find_all(exp.TableSample):
+        sample.set('seed', exp.Literal.number(seed))
+    return utils.to_duckdb_sql(tree)
+
+
+def num_mismatched_rows(conn, table_a, table_b):
+    """ Number of rows (with multiplicity) that are in only one of the two tables. """
+    return conn.sql(f"""
+        select
+            (select count(*) from (select * from {table_a} except all select * from {table_b}))
+            + (select count(*) from (select * from {table_b} except all select * from {table_a}))
+    """).fetchone()[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'Benchmark the feats.sql of a task against a baseline version of it (eg: the version '
+            'at another git revision), on each split, and check that both produce the same rows.'
+        )
+    )
+    parser.add_argument('--dataset', '-d', type=str, help='Relbench dataset name')
+    parser.add_argument('--task', '-t', type=str, help='Relbench task name')
+    parser.add_argument('--baseline', '-b', type=str, default='HEAD~1',
+                        help='Git revision of the baseline feats.sql, or a path to a template')
+    parser.add_argument('--sets', nargs='+', default=['train', 'val', 'test'],
+                        help='Splits to benchmark')
+    parser.add_argument('--subsample', '-s', type=int, default=0,
+                        help='Train subsample size (rows are not compared when subsampling)')
+    parser.add_argument('--repeats', '-r', type=int, default=1,
+                        help='Number of timed runs of each query (the fastest one is reported)')
+    parser.add_argument('--approx', action='store_true',
+                        help=(
+                            'Benchmark the approximate version of the feats.sql (see '
+                            'utils.approximate_query) against the exact one instead of a '
+                            'baseline, and report the error of each approximated column. '
+                            'Use with --subsample to measure the error on a sample of train.'
+                        ))
+    args = parser.parse_args()
+    task_params = TASK_PARAMS[f'{args.dataset}-{args.task}']
+    path = os.path.join(task_params['dir'], 'feats.sql')
+    conn = duckdb.connect(DATASET_TO_DB[args.dataset])
+
+    candidate = read_template(path)
+    if args.approx:
+        baseline = candidate
+    elif os.path.exists(args.baseline):
+        baseline = read_template(args.baseline)
+    else:
+        baseline = read_template(path, revision=args.baseline)
+
+    print(f'{"split":<8}{"baseline (s)":>14}{"candidate (s)":>15}{"speedup":>10}{"mismatches":>12}')
+    for set_ in args.sets:
+        context = dict(set=set_, subsample=args.subsample)
+        times = {}
+        for name, template in [('baseline', baseline), ('candidate', candidate)]:
+            query = utils.render_jinja_sql(
+                template, context, approx=args.approx and name == 'candidate'
+            )
+            if args.approx:
+                query = seed_samples(query)
+            times[name] = min(
+                time_query(conn, query, table_name=f'_bench_{name}', keep=True)
+                for _ in range(args.repeats)
+            )
+        if args.approx:
+            report = utils.approx_error_report(
+                conn.sql('select * from _bench_baseline').df(),
+                conn.sql('select * from _bench_candidate').df(),
+                task_params['identifier_cols'],
+            )
+            mismatches = f'{len(report)} cols'
+        elif set_ == 'train' and args.subsample > 0:
+            mismatches = 'n/a'
+        else:
+            mismatches = f'{num_mismatched_rows(conn, "_bench_baseline", "_bench_candidate"):,}'
+        conn.sql('drop table _bench_baseline')
+        conn.sql('drop table _bench_candidate')
+        speedup = times['baseline'] / max(times['candidate'], 1e-9)
+        print(
+            f'{set_:<8}{times["baseline"]:>14.2f}{times["candidate"]:>15.2f}'
+            f'{speedup:>9.2f}x{mismatches:>12}'
+        )
+        if args.approx and len(report) > 0:
+            print(report.to_string(float_format='{:.4f}'.format))
+    conn.close()
@@ -0,0 +1,198 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+import lightgbm
+import numpy as np
+import optuna
+from torch_frame import Metric, TaskType
+from torch_frame.gbdt import LightGBM
+
+import tracing
+
+# Dataset (binning) params are fixed across trials. feature_pre_filter=False lets min_data_in_leaf
+# vary per trial without lightgbm having to rebuild the histogram bins.
+DATASET_PARAMS = {'verbosity': -1, 'feature_pre_filter': False, 'max_bin': 255}
+
+
+class WarmStartLightGBM(LightGBM):
+    """ LightGBM tuner that builds the binned train/val datasets once and keeps the best trial.
+
+    Compared to torch_frame's LightGBM:
+      - The binned lightgbm Datasets are constructed once, shared by all trials and optionally
+        cached to disk (keyed on a hash of the data) so reruns skip binning entirely.
+      - Every trial early stops on the val set within the same num_boost_round budget, and the best
+        trial's booster becomes the final model instead of being retrained from scratch.
+      - If refit is set, the best config is retrained on train + val for the best trial's number of
+        boosting rounds.
+    """
+    def __init__(self, *args, cache_dir=None, refit=False, early_stopping_rounds=50, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_dir = cache_dir
+        self.refit = refit
+        self.early_stopping_rounds = early_stopping_rounds
+
+    def _dataset(self, tf, reference=None):
+        x, y, cat_features = self._to_lightgbm_input(tf)
+        path = None
+        if self.cache_dir is not None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(np.ascontiguousarray(x.values).tobytes())
+            digest.update(np.ascontiguousarray(y).tobytes())
+            digest.update(str(cat_features).encode())
+            if reference is not None:
+                digest.update(reference.cache_key.encode())
+            path = os.path.join(self.cache_dir, f'{digest.hexdigest()}.bin')
+        if path is not None and os.path.exists(path):
+            ds = lightgbm.Dataset(path, reference=reference, params=DATASET_PARAMS)
+        else:
+            ds = lightgbm.Dataset(
+                x.values, label=y, reference=reference, categorical_feature=cat_features,
+                params=DATASET_PARAMS, free_raw_data=False,
+            ).construct()
+            if path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                ds.save_binary(path)
+        ds.cache_key = path or ''
+        return ds, x, y, cat_features
+
+    def _trial_params(self, trial):
+        params = {
+            'verbosity': -1,
+            'bagging_freq': 1,
+            'max_depth': trial.suggest_int('max_depth', 3, 11),
+            'learning_rate': trial.suggest_float('learning_rate', 1e-3, 0.1, log=True),
+            'num_leaves': trial.suggest_int('num_leaves', 2, 2**10),
+            'subsample': trial.suggest_float('subsample', 0.05, 1.0),
+            'colsample_bytree': trial.suggest_float('colsample_bytree', 0.05, 1.0),
+            'lambda_l1': trial.suggest_float('lambda_l1', 1e-9, 10.0, log=True),
+            'lambda_l2': trial.suggest_float('lambda_l2', 1e-9, 10.0, log=True),
+            'min_data_in_leaf': trial.suggest_int('min_data_in_leaf', 1, 100),
+            'feature_pre_filter': False,
+        }
+        if self.task_type == TaskType.REGRESSION:
+            params['objective'] = 'regression' if self.metric == Metric.RMSE else 'regression_l1'
+            params['metric'] = 'rmse' if self.metric == Metric.RMSE else 'mae'
+        elif self.task_type == TaskType.BINARY_CLASSIFICATION:
+            params['objective'] = 'binary'
+            params['metric'] = 'auc' if self.metric == Metric.ROCAUC else 'binary_error'
+        else:
+            raise ValueError(f'{self.__class__.__name__} is not supported for {self.task_type}.')
+        return params
+
+    def _best_score(self, boost):
+        score = next(iter(boost.best_score['valid_0'].values()))
+        if self.metric == Metric.ACCURACY:
+            score = 1 - score  # binary_error
+        return score
+
+    def _early_stopping_train(self, params, train_data, eval_data, num_boost_round):
+        return lightgbm.train(
+            params, train_data, num_boost_round=num_boost_round, valid_sets=[eval_data],
+            callbacks=[
+                lightgbm.early_stopping(self.early_stopping_rounds, verbose=False),
+                lightgbm.log_evaluation(period=2000),
+            ])
+
+    def _refit(self, train_x, train_y, val_x, val_y, cat_features):
+        full_data = lightgbm.Dataset(
+            np.concatenate([train_x.values, val_x.values]),
+            label=np.concatenate([train_y, val_y]),
+            categorical_feature=cat_features,
+            params=DATASET_PARAMS,
+        )
+        self.model = lightgbm.train(self.params, full_data, num_boost_round=self.best_iteration)
+
+    def _tune(self, tf_train, tf_val, num_trials, num_boost_round=2000):
+        minimize = self.task_type == TaskType.REGRESSION
+        study = optuna.create_study(direction='minimize' if minimize else 'maximize')
+        train_data, train_x, train_y, cat_features = self._dataset(tf_train)
+        eval_data, val_x, val_y, _ = self._dataset(tf_val, reference=train_data)
+        best = {}
+
+        @tracing.traced('tune_trial')
+        def objective(trial):
+            params = self._trial_params(trial)
+            boost = self._early_stopping_train(params, train_data, eval_data, num_boost_round)
+            score = self._best_score(boost)
+            if not best or (score < best['score'] if minimize else score > best['score']):
+                best.update(score=score, model=boost, params=params)
+            return score
+
+        study.optimize(objective, num_trials)
+        self.params = best['params']
+        self.model = best['model']
+        self.best_iteration = self.model.best_iteration or num_boost_round
+        if self.refit:
+            self._refit(train_x, train_y, val_x, val_y, cat_features)
+
+
+def temporal_folds(timestamps, num_folds: int) -> list:
+    """ Rolling-origin folds over the label timestamps of a train split.
+
+    The distinct timestamps are cut into num_folds + 1 consecutive blocks, and fold k trains on the
+    rows of the blocks before block k and validates on the rows of block k. Returns (train, val)
+    row index arrays, so that the folds are views of the single materialized train table.
+    """
+    timestamps = np.asarray(timestamps)
+    distinct = np.unique(timestamps)
+    if len(distinct) < num_folds + 1:
+        raise ValueError(
+            f'{num_folds} temporal folds need at least {num_folds + 1} distinct train timestamps, '
+            f'found {len(distinct)}.'
+        )
+    block = np.searchsorted(distinct, timestamps) * (num_folds + 1) // len(distinct)
+    return [
+        (np.flatnonzero(block < k), np.flatnonzero(block == k)) for k in range(1, num_folds + 1)
+    ]
+
+
+class TemporalCVLightGBM(WarmStartLightGBM):
+    """ WarmStartLightGBM that scores trials by temporal cross-validation on the train split.
+
+    Each trial is scored by its mean early-stopped score over the temporal_folds of train, instead
+    of by a single val score. Train is binned once (see WarmStartLightGBM), and the folds are
+    lightgbm subsets of it that share its bin mappers, so adding folds neither reruns the feature
+    SQL nor rebins. The folds of a trial train concurrently and split num_threads (by default
+    OMP_NUM_THREADS, as set by nightly.py, or the number of CPUs) between them. The best config is
+    then trained on all of train, early stopped on val (and refit on train + val if refit is set).
+    """
+    def __init__(self, *args, timestamps=None, num_folds=3, num_threads=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timestamps = timestamps
+        self.num_folds = num_folds
+        self.num_threads = num_threads or int(os.environ.get('OMP_NUM_THREADS', os.cpu_count()))
+
+    def _tune(self, tf_train, tf_val, num_trials, num_boost_round=2000):
+        minimize = self.task_type == TaskType.REGRESSION
+        study = optuna.create_study(direction='minimize' if minimize else 'maximize')
+        train_data, train_x, train_y, cat_features = self._dataset(tf_train)
+        eval_data, val_x, val_y, _ = self._dataset(tf_val, reference=train_data)
+        folds = [
+            (train_data.subset(train_idx).construct(), train_data.subset(val_idx).construct())
+            for train_idx, val_idx in temporal_folds(self.timestamps, self.num_folds)
+        ]
+        parallel = min(len(folds), self.num_threads)
+        threads_per_fold = max(1, self.num_threads // parallel)
+
+        @tracing.traced('cv_fold')
+        def fit_fold(params, fold):
+            return self._best_score(self._early_stopping_train(params, *fold, num_boost_round))
+
+        @tracing.traced('tune_trial')
+        def objective(trial):
+            params = dict(self._trial_params(trial), num_threads=threads_per_fold)
+            with ThreadPoolExecutor(max_workers=parallel) as pool:
+                scores = list(pool.map(lambda fold: fit_fold(params, fold), folds))
+            trial.set_user_attr('fold_scores', scores)
+            return float(np.mean(scores))
+
+        study.optimize(objective, num_trials)
+        self.params = self._trial_params(optuna.trial.FixedTrial(study.best_params))
+        self.model = self._early_stopping_train(
+            self.params, train_data, eval_data, num_boost_round
+        )
+        self.best_iteration = self.model.best_iteration or num_boost_round
+        if self.refit:
+            self._refit(train_x, train_y, val_x, val_y, cat_features)
+
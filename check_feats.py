@@ -0,0 +1,97 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import time
+
+from feature_store import sql_hash
+from train_gbdt import DATASET_TO_DB, TASK_PARAMS
+import utils
+
+SPLITS = ['train', 'val', 'test']
+
+
+def explain_all(jobs, conns, subsample=0, max_workers=None):
+    """ Renders and EXPLAINs each (dataset, task, split) job in a thread pool, returning a dict from
+    job to error message (None if the query plans fine).
+
+    Each job runs on its own cursor of the dataset's connection (DuckDB plans queries without the
+    GIL), which conns holds as returned by utils.read_connection. Jobs whose rendered text is
+    identical are only planned once, and jobs of a dataset whose connection failed are not
+    rendered.
+    """
+    rendered, errors = {}, {}
+    for dataset, task, split in jobs:
+        if isinstance(conns[dataset], Exception):
+            errors[dataset, task, split] = f'connect: {conns[dataset]}'
+            continue
+        path = os.path.join(TASK_PARAMS[f'{dataset}-{task}']['dir'], 'feats.sql')
+        try:
+            rendered[dataset, task, split] = utils.render_jinja_file(
+                path, dict(set=split, subsample=subsample)
+            )
+        except Exception as e:
+            errors[dataset, task, split] = f'render: {type(e).__name__}: {e}'
+
+    def explain(dataset, query):
+        cursor = conns[dataset].cursor()
+        try:
+            # cursors don't inherit the `use` of read_connection
+            cursor.sql(f'use {utils.db_alias(DATASET_TO_DB[dataset])}')
+            cursor.sql(f'explain {query}')
+        except Exception as e:
+            return f'explain: {type(e).__name__}: {e}'
+        finally:
+            cursor.close()
+        return None
+
+    plans = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for (dataset, _, _), query in rendered.items():
+            key = (dataset, sql_hash(query))
+            if key not in plans:
+                plans[key] = pool.submit(explain, dataset, query)
+    for (dataset, task, split), query in rendered.items():
+        errors[dataset, task, split] = plans[dataset, sql_hash(query)].result()
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'Dry run: render and EXPLAIN the feats.sql of every task and split, to catch template '
+            'and SQL errors before generating features.'
+        )
+    )
+    parser.add_argument('--dataset', '-d', type=str, nargs='+', default=list(DATASET_TO_DB),
+                        help='Relbench dataset names (all by default)')
+    parser.add_argument('--subsample', '-s', type=int, default=0,
+                        help='Train subsample size used when rendering')
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count(),
+                        help='Number of queries planned concurrently')
+    args = parser.parse_args()
+
+    jobs = [
+        (dataset, task, split)
+        for dataset in args.dataset
+        for task in utils.DATASET_INFO[dataset]['tasks']
+        for split in SPLITS
+    ]
+    conns = {}
+    for dataset in args.dataset:
+        try:
+            conns[dataset] = utils.read_connection(DATASET_TO_DB[dataset])
+        except Exception as e:
+            conns[dataset] = e
+    start = time.time()
+    errors = explain_all(jobs, conns, args.subsample, args.workers)
+    for dataset, task, split in jobs:
+        error = errors[dataset, task, split]
+        status = 'ok' if error is None else error.splitlines()[0]
+        print(f'{dataset:<12}{task:<18}{split:<7}{status}')
+    num_failed = sum(e is not None for e in errors.values())
+    print(f'{len(jobs) - num_failed}/{len(jobs)} queries planned in {time.time() - start:.1f}s.')
+    for conn in conns.values():
+        if not isinstance(conn, Exception):
+            conn.close()
+    sys.exit(1 if num_failed else 0)
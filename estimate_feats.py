@@ -0,0 +1,220 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from feature_store import query_tables, sql_hash
+from prune_feats import time_query
+import tracing
+from train_gbdt import DATASET_TO_DB, TASK_PARAMS
+import utils
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# read by nightly.py, which uses them for feats nodes that never ran
+PREDICTIONS_PATH = os.path.join(ROOT, '.nightly', 'predictions.json')
+# train subsample sizes the cost model of a task is calibrated on
+CALIBRATION_SUBSAMPLES = [10_000, 30_000, 100_000]
+SPLITS = ['train', 'val', 'test']
+# estimated cardinalities in duckdb's EXPLAIN output (`EC: 123`, `~123 Rows` in later versions)
+_CARDINALITY = re.compile(r'EC:\s*(\d+)|~(\d+)\s+Rows')
+
+
+def plan_rows(conn, query) -> int:
+    """ Sum of the optimizer's estimated output rows over the operators of the query's plan, as a
+    proxy for the work the query does. """
+    plan = '\n'.join(str(row[-1]) for row in conn.sql(f'explain {query}').fetchall())
+    return sum(int(a or b) for a, b in _CARDINALITY.findall(plan))
+
+
+def table_rows(conn, query) -> dict:
+    """ Number of rows of each database table the query reads. """
+    return {
+        name: conn.sql(f'select count(*) from {name}').fetchone()[0]
+        for name in query_tables(query)
+    }
+
+
+def measure(db_filename, query, threads=None) -> dict:
+    """ Runs a feats.sql query into a temp table in a fresh process, so that the peak RSS is the
+    query's own, and returns its wall time, CPU time and peak RSS. """
+    with tempfile.NamedTemporaryFile('w', suffix='.sql', delete=False) as f:
+        f.write(query)
+    cmd = [sys.executable, os.path.join(ROOT, 'estimate_feats.py'), '--measure', f.name,
+           '--db', db_filename]
+    if threads is not None:
+        cmd += ['--threads', str(threads)]
+    try:
+        out = subprocess.run(cmd, capture_output=True, text=True, check=True, cwd=ROOT).stdout
+    finally:
+        os.remove(f.name)
+    return json.loads(out.splitlines()[-1])
+
+
+def _fit_line(xs, ys):
+    """ (intercept, slope) of the least-squares line through the points, with a slope >= 0. """
+    if len(set(xs)) < 2:
+        return 0.0, max(ys) / max(max(xs), 1)
+    slope, intercept = np.polyfit(xs, ys, 1)
+    if slope < 0:
+        return float(np.mean(ys)), 0.0
+    return float(intercept), float(slope)
+
+
+def calibrate(conn, db_filename, template, subsamples=CALIBRATION_SUBSAMPLES, threads=None):
+    """ Runs the train query of a feats.sql template at a few subsample sizes, and fits its wall
+    time and peak RSS as linear functions of plan_rows.
+
+    The fitted lines apply to every split of the task, since plan_rows already accounts for the
+    size of the labels and of the tables joined to them.
+    """
+    runs = []
+    for subsample in subsamples:
+        query = utils.render_jinja_sql(template, dict(set='train', subsample=subsample))
+        runs.append(dict(
+            subsample=subsample, plan_rows=plan_rows(conn, query),
+            **measure(db_filename, query, threads),
+        ))
+    xs = [r['plan_rows'] for r in runs]
+    return dict(
+        runs=runs,
+        wall_s=_fit_line(xs, [r['wall_s'] for r in runs]),
+        peak_rss_mb=_fit_line(xs, [r['peak_rss_mb'] for r in runs]),
+    )
+
+
+def predict(model, rows):
+    """ (wall seconds, peak RSS MB) predicted by a calibrated model for a query's plan_rows. """
+    return tuple(intercept + slope * rows for intercept, slope in (
+        model['wall_s'], model['peak_rss_mb']
+    ))
+
+
+def load_predictions(subsample=0) -> dict:
+    """ Saved predictions by nightly node id, leaving out those whose feats.sql changed since and
+    train predictions made for another subsample size. """
+    if not os.path.exists(PREDICTIONS_PATH):
+        return {}
+    with open(PREDICTIONS_PATH) as f:
+        predictions = json.load(f)
+    template_hashes = {}
+    valid = {}
+    for node_id, pred in predictions.items():
+        if pred['dir'] not in template_hashes:
+            path = os.path.join(ROOT, pred['dir'], 'feats.sql')
+            with open(path) as f:
+                template_hashes[pred['dir']] = sql_hash(f.read())
+        if pred['template_hash'] != template_hashes[pred['dir']]:
+            continue
+        if pred['split'] == 'train' and pred['subsample'] != subsample:
+            continue
+        valid[node_id] = pred
+    return valid
+
+
+def save_predictions(new_predictions: dict):
+    predictions = {}
+    if os.path.exists(PREDICTIONS_PATH):
+        with open(PREDICTIONS_PATH) as f:
+            predictions = json.load(f)
+    predictions.update(new_predictions)
+    os.makedirs(os.path.dirname(PREDICTIONS_PATH), exist_ok=True)
+    tmp_path = f'{PREDICTIONS_PATH}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(predictions, f, indent=2)
+    os.replace(tmp_path, PREDICTIONS_PATH)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'Predict the runtime and peak memory of the feats.sql of tasks at full size, from '
+            'duckdb\'s plan estimates calibrated on a few subsampled runs. Exits with code 1 if a '
+            'query is not predicted to fit in memory.'
+        )
+    )
+    parser.add_argument('--dataset', '-d', type=str, help='Relbench dataset name')
+    parser.add_argument('--task', '-t', type=str, nargs='+', default=None,
+                        help='Relbench task names (all tasks of the dataset by default)')
+    parser.add_argument('--subsample', '-s', type=int, default=0,
+                        help='Train subsample size to predict for (0 for the full train split)')
+    parser.add_argument('--calibration_subsamples', type=int, nargs='+',
+                        default=CALIBRATION_SUBSAMPLES,
+                        help='Train subsample sizes of the calibration runs')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Duckdb threads of the calibration runs (defaults to all CPUs)')
+    parser.add_argument('--memory_mb', type=float, default=None,
+                        help='Memory budget (defaults to 80%% of the physical memory)')
+    parser.add_argument('--save', action='store_true',
+                        help='Save the predictions for nightly.py to use as estimates')
+    # used by measure to run a calibration query in its own process
+    parser.add_argument('--measure', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--db', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        with open(args.measure) as f:
+            query = f.read()
+        conn = utils.read_connection(args.db)
+        if args.threads is not None:
+            conn.sql(f'set threads = {args.threads}')
+        with tracing.span('sql'):
+            time_query(conn, query)
+        conn.close()
+        record = tracing.SPANS[-1]
+        print(json.dumps({k: record[k] for k in ['wall_s', 'cpu_s', 'peak_rss_mb']}))
+        sys.exit(0)
+
+    max_memory_mb = args.memory_mb or (
+        0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**20
+    )
+    db_filename = DATASET_TO_DB[args.dataset]
+    conn = utils.read_connection(db_filename)
+    predictions = {}
+    print(
+        f'{"task":<18}{"split":<7}{"label rows":>12}{"table rows":>14}{"plan rows":>15}'
+        f'{"time (s)":>10}{"memory (MB)":>13}'
+    )
+    for task in args.task or utils.DATASET_INFO[args.dataset]['tasks']:
+        task_params = TASK_PARAMS[f'{args.dataset}-{task}']
+        with open(os.path.join(task_params['dir'], 'feats.sql')) as f:
+            template = f.read()
+        model = calibrate(
+            conn, db_filename, template, args.calibration_subsamples, threads=args.threads
+        )
+        for split in SPLITS:
+            query = utils.render_jinja_sql(template, dict(set=split, subsample=args.subsample))
+            rows = plan_rows(conn, query)
+            wall_s, peak_rss_mb = predict(model, rows)
+            sizes = table_rows(conn, query)
+            label_table = f'{task.replace("-", "_")}_{split}'
+            label_rows = sizes.pop(label_table, 0)
+            if split == 'train' and args.subsample > 0:
+                label_rows = min(label_rows, args.subsample)
+            fits = peak_rss_mb <= max_memory_mb
+            warning = '' if fits else '  WON\'T FIT'
+            print(
+                f'{task:<18}{split:<7}{label_rows:>12,}{sum(sizes.values()):>14,}{rows:>15,}'
+                f'{wall_s:>10,.0f}{peak_rss_mb:>13,.0f}{warning}'
+            )
+            predictions[f'{args.dataset}-{task}/feats/{split}'] = dict(
+                dir=task_params['dir'], split=split, subsample=args.subsample,
+                template_hash=sql_hash(template), plan_rows=rows, wall_s=wall_s,
+                peak_rss_mb=peak_rss_mb, fits=fits, runs=model['runs'],
+                predicted_at=datetime.datetime.now().isoformat(),
+            )
+    conn.close()
+    if args.save:
+        save_predictions(predictions)
+    too_big = [node_id for node_id, pred in predictions.items() if not pred['fits']]
+    if too_big:
+        print(
+            f'{len(too_big)} queries are predicted to need more than {max_memory_mb:,.0f} MB '
+            '(duckdb will spill to disk, if it can): ' + ', '.join(too_big)
+        )
+        sys.exit(1)
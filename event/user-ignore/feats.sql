@@ -1,3 +1,12 @@
+{% from 'macros.sql' import asof_offsets %}
+{% set offsets = [1, 2, 3, 4, 5] %}
+{% set att_cols = [
+    'num_invited', 'num_yes', 'num_no', 'num_maybe', 'avg_event_start_hour', 'modal_event_dow'
+] %}
+{% set int_cols = [
+    'num_invites', 'num_interested', 'num_not_interested', 'num_invited_and_interested',
+    'num_invited_and_not_interested'
+] %}
 create or replace table user_ignore_{{ set }}_feats as -- noqa
 
 with labels as materialized (
@@ -46,6 +55,8 @@ attendance_window_fns as materialized (
         avg(date_part('hour', a.start_time)) over monthly as avg_event_start_hour,
         mode(date_part('dow', a.start_time)) over monthly as modal_event_dow
     from event_attendees as a
+    -- windows are per user, so only label users are needed (this also lets sharding shrink them)
+    where a.user_id in (select labels.user from labels)
     window monthly as (
         partition by a.user_id
         order by a.start_time asc
@@ -65,11 +76,25 @@ interest_window_fns as materialized (
         sum((i.invited::bool and i.not_interested::bool)::int) over monthly
         as num_invited_and_not_interested
     from event_interest as i
+    where i.user in (select labels.user from labels)
     window monthly as (
         partition by i.user
         order by i.timestamp asc
         range between interval '1 month' preceding and current row
     )
+),
+
+-- all past_{i} offsets of each window table in one asof join (see macros.sql)
+past_attendance as (
+    {{ asof_offsets(
+        'labels', 'user', 'attendance_window_fns', 'user_id', att_cols, offsets, 'month', 'past'
+    ) }}
+),
+
+past_interest as (
+    {{ asof_offsets(
+        'labels', 'user', 'interest_window_fns', 'user_id', int_cols, offsets, 'month', 'past'
+    ) }}
 )
 
 select
@@ -79,18 +104,14 @@ select
         labels.target,
     {% endif %}
     user_feats.* exclude (user_id, timestamp),
-{% for i in [1, 2, 3, 4, 5] %}
-    past_{{ i }}_att.num_invited as past_{{ i }}_num_invited,
-    past_{{ i }}_att.num_yes as past_{{ i }}_num_yes,
-    past_{{ i }}_att.num_no as past_{{ i }}_num_no,
-    past_{{ i }}_att.num_maybe as past_{{ i }}_num_maybe,
-    past_{{ i }}_att.avg_event_start_hour as past_{{ i }}_avg_event_start_hour,
-    past_{{ i }}_att.modal_event_dow as past_{{ i }}_modal_event_dow,
-    past_{{ i }}_int.num_invites as past_{{ i }}_num_invites,
-    past_{{ i }}_int.num_interested as past_{{ i }}_num_interested,
-    past_{{ i }}_int.num_not_interested as past_{{ i }}_num_not_interested,
-    past_{{ i }}_int.num_invited_and_interested as past_{{ i }}_num_invited_and_interested,
-    past_{{ i }}_int.num_invited_and_not_interested as past_{{ i }}_num_invited_and_not_interested
+{% for i in offsets %}
+    {% for col in att_cols %}
+        past_attendance.past_{{ i }}_{{ col }},
+    {% endfor %}
+    {% for col in int_cols %}
+        past_interest.past_{{ i }}_{{ col }}
+        {%- if not loop.last %},{% endif %} -- noqa
+    {% endfor %}
 {%- if not loop.last %},{% endif %} -- noqa
 {% endfor %}
 from labels
@@ -98,13 +119,11 @@ left join user_feats
     on
         labels.user = user_feats.user_id
         and labels.timestamp = user_feats.timestamp
-{% for i in [1, 2, 3, 4, 5] %}
-    asof left join attendance_window_fns as past_{{ i }}_att
-        on
-            labels.user = past_{{ i }}_att.user_id
-            and labels.timestamp - interval '{{ i - 1 }} month' > past_{{ i }}_att.timestamp
-    asof left join interest_window_fns as past_{{ i }}_int
-        on
-            labels.user = past_{{ i }}_int.user_id
-            and labels.timestamp - interval '{{ i - 1 }} month' > past_{{ i }}_int.timestamp
-{% endfor %}
+left join past_attendance
+    on
+        labels.user = past_attendance.user
+        and labels.timestamp = past_attendance.timestamp
+left join past_interest
+    on
+        labels.user = past_interest.user
+        and labels.timestamp = past_interest.timestamp
@@ -1,3 +1,4 @@
+{% from 'macros.sql' import window_aggs %}
 create or replace table driver_dnf_{{ set }}_feats as -- noqa
 
 with labels as materialized (
@@ -136,6 +137,51 @@ upcoming_race_features as (
             and upcoming.date <= (labels.date + interval '1 month')
     left join circuits
         on upcoming.circuitId = circuits.circuitId
+),
+
+-- one pass over the past and upcoming races of each label for all offsets (see macros.sql)
+past_race_pivot as (
+    select
+        driverId,
+        date,
+        {{ window_aggs(
+            [
+                ('driver_position', 'any_value(driver_position) {filter}'),
+                ('driver_points', 'any_value(driver_points) {filter}'),
+                ('driver_grid', 'any_value(driver_grid) {filter}'),
+                ('position_gain', 'any_value(position_gain) {filter}'),
+                ('driver_rank', 'any_value(driver_rank) {filter}'),
+                ('pct_laps_completed', 'any_value(pct_laps_completed) {filter}'),
+                ('dnf', 'any_value(dnf) {filter}'),
+                ('constructor_points', 'any_value(constructor_points) {filter}'),
+            ],
+            [1, 2, 3],
+            ['i'],
+            'races_ago = {i}',
+            'past_{i}',
+            prefix=True,
+        ) }}
+    from past_race_features
+    group by driverId, date
+),
+
+upcoming_race_pivot as (
+    select
+        driverId,
+        date,
+        {{ window_aggs(
+            [
+                ('round', 'any_value(round) {filter}'),
+                ('circuit_id', 'any_value(circuitId) {filter}'),
+            ],
+            [1, 2, 3],
+            ['i'],
+            'races_ahead = {i}',
+            'upcoming_{i}',
+            prefix=True,
+        ) }}
+    from upcoming_race_features
+    group by driverId, date
 )
 
 select
@@ -146,16 +192,16 @@ select
     {% endif %}
     basic_feats.* exclude(driverId, date),
     {% for i in [1, 2, 3] %}
-        past_{{ i }}.driver_position as past_{{ i }}_driver_position,
-        past_{{ i }}.driver_points as past_{{ i }}_driver_points,
-        past_{{ i }}.driver_grid as past_{{ i }}_driver_grid,
-        past_{{ i }}.position_gain as past_{{ i }}_position_gain,
-        past_{{ i }}.driver_rank as past_{{ i }}_driver_rank,
-        past_{{ i }}.pct_laps_completed as past_{{ i }}_pct_laps_completed,
-        past_{{ i }}.dnf as past_{{ i }}_dnf,
-        past_{{ i }}.constructor_points as past_{{ i }}_constructor_points,
-        upcoming_{{ i }}.round as upcoming_{{ i }}_round,
-        upcoming_{{ i }}.circuitId as upcoming_{{ i }}_circuit_id
+        past_race_pivot.past_{{ i }}_driver_position,
+        past_race_pivot.past_{{ i }}_driver_points,
+        past_race_pivot.past_{{ i }}_driver_grid,
+        past_race_pivot.past_{{ i }}_position_gain,
+        past_race_pivot.past_{{ i }}_driver_rank,
+        past_race_pivot.past_{{ i }}_pct_laps_completed,
+        past_race_pivot.past_{{ i }}_dnf,
+        past_race_pivot.past_{{ i }}_constructor_points,
+        upcoming_race_pivot.upcoming_{{ i }}_round,
+        upcoming_race_pivot.upcoming_{{ i }}_circuit_id
         {%- if not loop.last %},{% endif %} -- noqa
     {% endfor %}
 from labels
@@ -163,15 +209,11 @@ left join basic_feats
     on
         labels.driverId = basic_feats.driverId
         and labels.date = basic_feats.date
-{% for i in [1, 2, 3] %}
-    left join past_race_features as past_{{ i }}
-        on
-            labels.driverId = past_{{ i }}.driverId
-            and labels.date = past_{{ i }}.date
-            and past_{{ i }}.races_ago = {{ i }}
-    left join upcoming_race_features as upcoming_{{ i }}
-        on
-            labels.driverId = upcoming_{{ i }}.driverId
-            and labels.date = upcoming_{{ i }}.date
-            and upcoming_{{ i }}.races_ahead = {{ i }}
-{% endfor %}
+left join past_race_pivot
+    on
+        labels.driverId = past_race_pivot.driverId
+        and labels.date = past_race_pivot.date
+left join upcoming_race_pivot
+    on
+        labels.driverId = upcoming_race_pivot.driverId
+        and labels.date = upcoming_race_pivot.date
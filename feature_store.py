@@ -0,0 +1,177 @@
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import duckdb
+import sqlglot
+from sqlglot import exp
+
+import utils
+
+CURRENT_FILE = 'CURRENT'
+DATA_FILE = 'data.parquet'
+METADATA_FILE = 'metadata.json'
+
+
+def sql_hash(query: str) -> str:
+    """ Hash of a rendered feats.sql query (whitespace insensitive). """
+    return hashlib.sha1(' '.join(query.split()).encode()).hexdigest()
+
+
+def query_tables(query: str) -> list:
+    """ Names of the database tables a rendered feats.sql query reads (CTEs and the table the query
+    creates are left out). """
+    tree = sqlglot.parse_one(query, read='duckdb')
+    skip = {cte.alias for cte in tree.find_all(exp.CTE)}
+    if isinstance(tree, exp.Create):
+        skip.add(tree.this.name)
+    return sorted({t.name for t in tree.find_all(exp.Table) if t.name and t.name not in skip})
+
+
+def data_fingerprint(conn: duckdb.DuckDBPyConnection, query: str) -> str:
+    """ Fingerprint of the data a rendered feats.sql query reads: the schema, row count and latest
+    date/timestamp of each of its tables. It changes when a table is rebuilt with other contents,
+    gets rows appended (eg: an incremental `since` update of derived tables) or columns added. """
+    tables = {}
+    for name in query_tables(query):
+        rel = conn.sql(f'select * from {name}')
+        schema = [[c, str(t)] for c, t in zip(rel.columns, rel.types)]
+        time_cols = [c for c, t in schema if t.startswith(('DATE', 'TIMESTAMP'))]
+        aggs = ['count(*)'] + [f'max("{c}")::varchar' for c in time_cols]
+        stats = conn.sql(f'select {", ".join(aggs)} from {name}').fetchone()
+        tables[name] = [schema, list(stats)]
+    return hashlib.sha1(json.dumps(tables, sort_keys=True).encode()).hexdigest()
+
+
+def _split_dir(store_dir: str, table_name: str) -> str:
+    return os.path.join(store_dir, table_name)
+
+
+def list_versions(store_dir: str, table_name: str) -> list:
+    """ Metadata of every stored version of a feature table, oldest first. """
+    split_dir = _split_dir(store_dir, table_name)
+    if not os.path.isdir(split_dir):
+        return []
+    versions = []
+    for version in sorted(os.listdir(split_dir)):
+        path = os.path.join(split_dir, version, METADATA_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                versions.append(json.load(f))
+    return versions
+
+
+def current_version(store_dir: str, table_name: str) -> str:
+    """ Version currently pointed to for a feature table, or None if nothing was stored yet. """
+    path = os.path.join(_split_dir(store_dir, table_name), CURRENT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def set_current(store_dir: str, table_name: str, version: str):
+    """ Points a feature table to one of its stored versions (eg: to roll back a regeneration). """
+    split_dir = _split_dir(store_dir, table_name)
+    if not os.path.exists(os.path.join(split_dir, version, METADATA_FILE)):
+        raise ValueError(f'Version "{version}" of {table_name} not found in {store_dir}.')
+    tmp_path = os.path.join(split_dir, f'.{CURRENT_FILE}.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(version + '\n')
+    os.replace(tmp_path, os.path.join(split_dir, CURRENT_FILE))
+
+
+def find_version(
+    store_dir: str, table_name: str, query_hash: str, subsample: int = 0, data_hash: str = None
+) -> str:
+    """ Latest stored version generated from the same rendered query and subsample, over the same
+    data (see data_fingerprint), if any. """
+    for meta in reversed(list_versions(store_dir, table_name)):
+        if (
+            meta['sql_hash'] == query_hash and meta['subsample'] == subsample
+            and meta.get('data_hash') == data_hash
+        ):
+            return meta['version']
+    return None
+
+
+def write_version(
+    conn: duckdb.DuckDBPyConnection,
+    query: str,
+    store_dir: str,
+    table_name: str,
+    subsample: int = 0,
+    make_current: bool = True,
+    write_fn=None,
+    data_hash: str = None,
+) -> dict:
+    """ Runs a rendered feats.sql query and stores its result as a new immutable Parquet version.
+
+    The query is copied to Parquet (see utils.copy_to_parquet) so nothing is written to the
+    database itself, unless write_fn is given, in which case write_fn(path) is expected to write the
+    query's result to the Parquet file at path (eg: see sharding.py). Files are written to a staging
+    directory that is renamed into place once complete, so readers never see a partial version.
+    data_hash is computed from conn if not given. Returns the version's metadata.
+    """
+    write_fn = write_fn or (lambda path: utils.copy_to_parquet(conn, query, path))
+    query_hash = sql_hash(query)
+    # fingerprinted before the query runs, so data changed meanwhile isn't recorded as used
+    data_hash = data_hash or data_fingerprint(conn, query)
+    version = f'{datetime.datetime.now():%Y%m%dT%H%M%S%f}_{query_hash[:8]}'
+    split_dir = _split_dir(store_dir, table_name)
+    staging_dir = os.path.join(split_dir, f'.{version}.tmp')
+    os.makedirs(staging_dir)
+    try:
+        data_path = os.path.join(staging_dir, DATA_FILE)
+        start = time.time()
+        write_fn(data_path)
+        generate_seconds = time.time() - start
+        rel = conn.sql(f"select * from read_parquet('{data_path}')")
+        meta = {
+            'version': version,
+            'table_name': table_name,
+            'sql_hash': query_hash,
+            'subsample': subsample,
+            'data_hash': data_hash,
+            'num_rows': conn.sql(f"select count(*) from read_parquet('{data_path}')").fetchone()[0],
+            'columns': [[c, str(t)] for c, t in zip(rel.columns, rel.types)],
+            'generate_seconds': generate_seconds,
+            'created_at': datetime.datetime.now().isoformat(),
+        }
+        with open(os.path.join(staging_dir, METADATA_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.rename(staging_dir, os.path.join(split_dir, version))
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    if make_current:
+        set_current(store_dir, table_name, version)
+    return meta
+
+
+def version_path(store_dir: str, table_name: str, version: str = None) -> str:
+    """ Path of the Parquet file of a version (the current one by default). """
+    version = version or current_version(store_dir, table_name)
+    if version is None:
+        raise ValueError(f'No stored version of {table_name} in {store_dir}.')
+    return os.path.join(_split_dir(store_dir, table_name), version, DATA_FILE)
+
+
+def register_views(
+    conn: duckdb.DuckDBPyConnection, store_dir: str, table_names: list, versions: dict = None
+):
+    """ Creates temp views named like the feature tables over their stored Parquet versions.
+
+    The views shadow tables of the same name in the database, so code that reads feature tables by
+    name reads the stored versions instead, with projection pushdown into the Parquet files. Only
+    temp objects are created, so this works on read-only connections too.
+    """
+    versions = versions or {}
+    for table_name in table_names:
+        path = version_path(store_dir, table_name, versions.get(table_name))
+        conn.sql(
+            f"create or replace temp view {table_name} as select * from read_parquet('{path}')"
+        )
@@ -0,0 +1,60 @@
+{#-
+    Per-article sales statistics over the 3 months up to each sale day, one row per (article, sale
+    day), used by user-churn. ASOF joining on `ts > t_dat` gives an article's statistics as of any
+    point in time ts.
+
+    With `since` (a date) only the rows of days from `since` on are recomputed, for the articles
+    sold since then (see customer_txn_history.sql).
+-#}
+{% if since is none %}
+create or replace table article_txn_history as -- noqa
+{% else %}
+delete from article_txn_history where t_dat >= '{{ since }}'; -- noqa
+insert into article_txn_history by name -- noqa
+{% endif %}
+
+with daily as (
+    select
+        article_id,
+        t_dat,
+        count(*) as num_sales,
+        sum(price) as sales_amount
+    from transactions
+    {% if since is not none %}
+    where article_id in (
+        select article_id from transactions where t_dat >= '{{ since }}' -- noqa
+    )
+    {% endif %}
+    group by article_id, t_dat
+),
+
+running as (
+    select
+        article_id,
+        t_dat,
+        (sum(sales_amount) over monthly) / 3 as rolling_monthly_sales_amount,
+        (sum(num_sales) over monthly) / 3 as rolling_monthly_sales_count,
+        date_diff(
+            'days',
+            lag(t_dat, 1) over (partition by article_id order by t_dat asc),
+            t_dat
+        ) as days_since_last_sale
+    from daily
+    window monthly as (
+        partition by article_id
+        order by t_dat asc
+        range between interval '3 month' preceding and current row
+    )
+)
+
+select
+    article_id,
+    t_dat,
+    rolling_monthly_sales_amount,
+    rolling_monthly_sales_count,
+    days_since_last_sale
+from running
+{% if since is not none %}
+where t_dat >= '{{ since }}'
+{% endif %}
+order by article_id, t_dat
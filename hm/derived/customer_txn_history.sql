@@ -0,0 +1,161 @@
+{#-
+    Per-customer purchase statistics, one row per (customer, purchase day): over the 3 months up to
+    the day (used by item-sales) and over all time (used by user-churn). ASOF joining on
+    `ts > t_dat` gives a customer's statistics as of any point in time ts.
+
+    With `since` (a date) only the rows of days from `since` on are recomputed, for the customers
+    who bought something since then, which is what appending new transaction days requires (see
+    utils.create_derived_tables).
+-#}
+{% set modes = [
+    ('modal_dept_no', 'department_no'),
+    ('modal_section_no', 'section_no'),
+    ('modal_color_id', 'perceived_colour_master_id'),
+] %}
+{% if since is none %}
+create or replace table customer_txn_history as -- noqa
+{% else %}
+delete from customer_txn_history where t_dat >= '{{ since }}'; -- noqa
+insert into customer_txn_history by name -- noqa
+{% endif %}
+
+with txns as (
+    select
+        t.customer_id,
+        t.t_dat,
+        t.article_id,
+        t.price,
+        t.sales_channel_id
+    from transactions as t
+    {% if since is not none %}
+        where t.customer_id in (
+            select customer_id from transactions where t_dat >= '{{ since }}' -- noqa
+        )
+    {% endif %}
+),
+
+daily as (
+    select
+        customer_id,
+        t_dat,
+        count(*) as num_purchases,
+        sum(price) as purchase_amount,
+        sum(sales_channel_id - 1) as num_sales_channel_2
+    from txns
+    group by customer_id, t_dat
+),
+
+-- number of articles the customer bought for the first time on each day
+new_articles as (
+    select
+        customer_id,
+        t_dat,
+        count(*) as num_new_articles
+    from (
+        select
+            customer_id,
+            article_id,
+            min(t_dat) as t_dat
+        from txns
+        group by customer_id, article_id
+    ) as first_purchases
+    group by customer_id, t_dat
+),
+
+-- all time modes: running counts only grow, so the value with the highest running count on any
+-- day so far is the most frequent one
+{% for name, col in modes %}
+    {{ name }} as (
+        select
+            customer_id,
+            t_dat,
+            any_value(mode_value) as {{ name }}
+        from (
+            select
+                customer_id,
+                t_dat,
+                arg_max(value, running_count) over (
+                    partition by customer_id
+                    order by t_dat asc
+                    range between unbounded preceding and current row
+                ) as mode_value
+            from (
+                select
+                    txns.customer_id,
+                    txns.t_dat,
+                    article.{{ col }} as value,
+                    sum(count(*)) over (
+                        partition by txns.customer_id, article.{{ col }}
+                        order by txns.t_dat asc
+                        rows between unbounded preceding and current row
+                    ) as running_count
+                from txns
+                inner join article
+                    on txns.article_id = article.article_id
+                where article.{{ col }} is not null
+                group by txns.customer_id, txns.t_dat, article.{{ col }}
+            )
+        )
+        group by customer_id, t_dat
+    ),
+
+{% endfor %}
+running as (
+    select
+        daily.customer_id,
+        daily.t_dat,
+        (sum(daily.purchase_amount) over monthly) / 3 as rolling_monthly_purchase_amount,
+        (sum(daily.num_purchases) over monthly) / 3 as rolling_monthly_purchase_count,
+        date_diff(
+            'week',
+            lag(daily.t_dat, 1) over (partition by daily.customer_id order by daily.t_dat asc),
+            daily.t_dat
+        ) as weeks_since_last_purchase,
+        (sum(daily.num_purchases) over all_time)::bigint as total_purchase_count,
+        sum(daily.purchase_amount) over all_time as total_purchase_amount,
+        coalesce(sum(new_articles.num_new_articles) over all_time, 0)::bigint
+            as total_unique_articles_purchased,
+        sum(daily.num_sales_channel_2) over all_time as total_sales_channel_2
+    from daily
+    left join new_articles
+        on
+            daily.customer_id = new_articles.customer_id
+            and daily.t_dat = new_articles.t_dat
+    window
+        monthly as (
+            partition by daily.customer_id
+            order by daily.t_dat asc
+            range between interval '3 month' preceding and current row
+        ),
+        all_time as (
+            partition by daily.customer_id
+            order by daily.t_dat asc
+            rows between unbounded preceding and current row
+        )
+)
+
+select
+    running.customer_id,
+    running.t_dat,
+    running.rolling_monthly_purchase_amount,
+    running.rolling_monthly_purchase_count,
+    running.weeks_since_last_purchase,
+    running.total_purchase_count,
+    running.total_purchase_amount,
+    running.total_purchase_amount / running.total_purchase_count as avg_purchase_price,
+    running.total_unique_articles_purchased,
+    running.total_sales_channel_2 / running.total_purchase_count as prop_sales_channel_2,
+    {% for name, _ in modes %}
+        {{ name }}.{{ name }}{% if not loop.last %},{% endif %}
+    {% endfor %}
+from running
+{% for name, _ in modes %}
+    left join {{ name }}
+        on
+            running.customer_id = {{ name }}.customer_id
+            and running.t_dat = {{ name }}.t_dat
+{% endfor %}
+{% if since is not none %}
+    where running.t_dat >= '{{ since }}'
+{% endif %}
+order by running.customer_id, running.t_dat
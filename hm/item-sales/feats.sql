@@ -1,3 +1,5 @@
+{% from 'macros.sql' import window_aggs %}
+{% set windows = [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5)] %}
 create or replace table item_sales_{{ set }}_feats as -- noqa
 
 with labels as materialized (
@@ -8,57 +10,52 @@ with labels as materialized (
     {% endif %}
 ),
 
-txn_window_fns as materialized (
+-- one pass over transactions for all windows (see macros.sql)
+txn_window_aggs as (
     select
-        t.customer_id,
-        t.t_dat,
-        (sum(t.price) over monthly) / 3 as rolling_monthly_purchase_amount,
-        (count(*) over monthly) / 3 as rolling_monthly_purchase_count,
-        date_diff(
-            'week',
-            lag(t.t_dat, 1) over (partition by t.customer_id order by t.t_dat asc),
-            t.t_dat
-        ) as weeks_since_last_purchase
-    from transactions as t
-    window monthly as (
-        partition by t.customer_id
-        order by t.t_dat asc
-        range between interval '3 month' preceding and current row
-    )
-),
-
-{% for w in [1, 2, 3, 4, 5] %}
-    txn_window_aggs_{{ w }}_weeks_ago as (
-        select
-            labels.article_id,
-            labels.timestamp,
-            count(*) as num_sales_{{ w }}_weeks_ago,
-            sum(t.price) as sold_amount_{{ w }}_weeks_ago,
-            avg(t.price) as avg_price_{{ w }}_weeks_ago,
-            count(distinct t.customer_id) as num_customers_{{ w }}_weeks_ago,
-            -- aggs of buyer features
-            avg(customer.age) as avg_buyer_age_{{ w }}_weeks_ago,
-            avg(txn_window_fns.rolling_monthly_purchase_amount)
-            as avg_monthly_purchase_amount_{{ w }}_weeks_ago,
-            avg(txn_window_fns.rolling_monthly_purchase_count)
-            as avg_monthly_purchase_count_{{ w }}_weeks_ago,
-            avg(txn_window_fns.weeks_since_last_purchase)
-            as avg_weeks_since_last_purchase_{{ w }}_weeks_ago
-        from labels
-        left join transactions as t
-            on
-                labels.article_id = t.article_id
-                and labels.timestamp - interval '{{ w - 1 }} weeks' > t.t_dat
-                and labels.timestamp - interval '{{ w }} weeks' <= t.t_dat
-        left join customer
-            on t.customer_id = customer.customer_id
-        asof left join txn_window_fns
-            on
-                t.customer_id = txn_window_fns.customer_id
-                and labels.timestamp > txn_window_fns.t_dat
-        group by labels.article_id, labels.timestamp
-    ){% if not loop.last %},{% endif %}
-{% endfor %}
+        labels.article_id,
+        labels.timestamp,
+        {{ window_aggs(
+            [
+                ('num_sales', 'greatest(count(*) {filter}, 1)'),
+                ('sold_amount', 'sum(t.price) {filter}'),
+                ('avg_price', 'avg(t.price) {filter}'),
+                ('num_customers', 'count(distinct t.customer_id) {filter}'),
+                ('avg_buyer_age', 'avg(customer.age) {filter}'),
+                (
+                    'avg_monthly_purchase_amount',
+                    'avg(buyer.rolling_monthly_purchase_amount) {filter}'
+                ),
+                (
+                    'avg_monthly_purchase_count',
+                    'avg(buyer.rolling_monthly_purchase_count) {filter}'
+                ),
+                (
+                    'avg_weeks_since_last_purchase',
+                    'avg(buyer.weeks_since_last_purchase) {filter}'
+                ),
+            ],
+            windows,
+            ('lb', 'w'),
+            "labels.timestamp - interval '{lb} weeks' > t.t_dat "
+            ~ "and labels.timestamp - interval '{w} weeks' <= t.t_dat",
+            '{w}_weeks_ago',
+        ) }}
+    from labels
+    left join transactions as t
+        on
+            labels.article_id = t.article_id
+            and labels.timestamp - interval '{{ windows[0][0] }} weeks' > t.t_dat
+            and labels.timestamp - interval '{{ windows[-1][1] }} weeks' <= t.t_dat
+    left join customer
+        on t.customer_id = customer.customer_id
+    -- buyer features as of the label timestamp (see hm/derived/customer_txn_history.sql)
+    asof left join customer_txn_history as buyer
+        on
+            t.customer_id = buyer.customer_id
+            and labels.timestamp > buyer.t_dat
+    group by labels.article_id, labels.timestamp
+)
 
 select
     labels.article_id,
@@ -76,16 +73,11 @@ select
     article.section_no,
     article.perceived_colour_master_id,
     -- window features
-    {% for w in [1, 2, 3, 4, 5] %}
-        txn_window_aggs_{{ w }}_weeks_ago.* exclude(article_id, timestamp)
-        {%- if not loop.last %},{% endif %} -- noqa
-    {% endfor %}
+    txn_window_aggs.* exclude(article_id, timestamp) -- noqa
 from labels
 left join article
     on labels.article_id = article.article_id
-{% for w in [1, 2, 3, 4, 5] %}
-left join txn_window_aggs_{{ w }}_weeks_ago
+left join txn_window_aggs
     on
-        labels.article_id = txn_window_aggs_{{ w }}_weeks_ago.article_id
-        and labels.timestamp = txn_window_aggs_{{ w }}_weeks_ago.timestamp
-{% endfor %}
+        labels.article_id = txn_window_aggs.article_id
+        and labels.timestamp = txn_window_aggs.timestamp
@@ -140,6 +140,7 @@ task_to_stypes = {
         'customer_id': stype.numerical,
         'timestamp': stype.timestamp,
         'churn': stype.categorical,
+        'weeks_since_first_review': stype.numerical,
         'num_reviews': stype.numerical,
         'sum_review_ratings': stype.numerical,
         'avg_review_length': stype.numerical,
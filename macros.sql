@@ -0,0 +1,81 @@
+{#-
+    Shared Jinja macros for feats.sql files. Import with:
+        {% from 'macros.sql' import window_aggs %}
+-#}
+
+{#-
+    Emits conditional aggregates for several lookback windows computed over a single join, instead
+    of one CTE (and one scan of the fact table) per window.
+
+    aggs: list of (name, expression) pairs. `{filter}` in an expression is replaced by the window's
+        `filter (where ...)` clause, and window variables (eg: `{lb}`) are substituted as well.
+    windows: list of windows, each a value or a tuple of values (eg: [1, 2] or [(0, 3), (3, 6)]).
+    names: names of the window values, used as format fields in condition and suffix.
+    condition: filter condition of a window, eg: "t.t_dat >= labels.timestamp - interval '{w} weeks'".
+    suffix: appended to each agg name, eg: '{w}_weeks_ago' (or prepended to it, if prefix is set).
+-#}
+{% macro window_aggs(aggs, windows, names, condition, suffix, prefix=False) -%}
+    {%- for window in windows -%}
+        {%- set values = window if window is sequence else [window] -%}
+        {%- set vars = {} -%}
+        {%- for name in names -%}
+            {%- set _ = vars.update({name: values[loop.index0]}) -%}
+        {%- endfor -%}
+        {%- set window_filter = 'filter (where ' ~ condition.format(**vars) ~ ')' -%}
+        {%- set outer_loop = loop -%}
+        {%- for agg_name, expression in aggs %}
+        {{ expression.format(filter=window_filter, **vars) }}
+        {%- if prefix %}
+        as {{ suffix.format(**vars) }}_{{ agg_name }}
+        {%- else %}
+        as {{ agg_name }}_{{ suffix.format(**vars) }}
+        {%- endif %}
+        {%- if not (outer_loop.last and loop.last) %},{% endif %}
+        {%- endfor -%}
+    {%- endfor -%}
+{%- endmacro %}
+
+{#-
+    Emits a query that, for every distinct (key, timestamp) in `keys` and every offset i, looks up the
+    latest row of `table` strictly before `timestamp - (i - 1) <unit>`, and pivots the results into
+    `{prefix}_{i}_{col}` columns. All offsets are resolved by a single asof join (one sort of each
+    side) instead of one asof join per offset.
+
+    keys: relation with a `key` column and a `timestamp` column (eg: labels).
+    table: relation with a `table_key` column and a `timestamp` column, eg: a window function table.
+    cols: columns of `table` to look up.
+    offsets: offsets to look up (eg: [1, 2, 3]), where offset 1 is as of `timestamp` itself.
+-#}
+{% macro asof_offsets(keys, key, table, table_key, cols, offsets, unit, prefix) -%}
+    select
+        probes.{{ key }},
+        probes.timestamp,
+        {%- for i in offsets %}
+            {%- set outer_loop = loop %}
+            {%- for col in cols %}
+        any_value(lookup.{{ col }}) filter (where probes.lookup_offset = {{ i }})
+        as {{ prefix }}_{{ i }}_{{ col }}
+            {%- if not (outer_loop.last and loop.last) %},{% endif %}
+            {%- endfor %}
+        {%- endfor %}
+    from (
+        select
+            keys.{{ key }},
+            keys.timestamp,
+            offsets.lookup_offset,
+            keys.timestamp - offsets.lag as lookup_timestamp
+        from (select distinct k.{{ key }}, k.timestamp from {{ keys }} as k) as keys
+        cross join (
+            values
+            {%- for i in offsets %}
+                ({{ i }}, interval '{{ i - 1 }} {{ unit }}')
+                {%- if not loop.last %},{% endif %}
+            {%- endfor %}
+        ) as offsets (lookup_offset, lag)
+    ) as probes
+    asof left join {{ table }} as lookup
+        on
+            probes.{{ key }} = lookup.{{ table_key }}
+            and probes.lookup_timestamp > lookup.timestamp
+    group by probes.{{ key }}, probes.timestamp
+{%- endmacro %}
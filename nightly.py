@@ -0,0 +1,394 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import duckdb
+
+import estimate_feats
+import feature_store
+from train_gbdt import DATASET_TO_DB, TASK_PARAMS
+import utils
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATE_DIR = os.path.join(ROOT, '.nightly')
+HISTORY_PATH = os.path.join(STATE_DIR, 'history.json')
+POLL_SECONDS = 1.0
+MAX_ATTEMPTS = 3
+# memory (and thread) estimates are the max over the last few successful runs, padded
+HISTORY_RUNS = 3
+MEMORY_PADDING = 1.25
+# estimates for nodes that never ran
+DEFAULT_MEMORY_MB = {'db_setup': 16_000, 'derived': 8_000, 'feats': 8_000, 'train': 16_000}
+DEFAULT_THREADS = {'db_setup': 1, 'derived': 8, 'feats': 8, 'train': 8}
+DEFAULT_WALL_S = {'db_setup': 1800, 'derived': 300, 'feats': 300, 'train': 1800}
+# exit code of a node that ran out of memory on its own (eg: duckdb's OutOfMemoryException)
+OOM_EXIT_CODE = 75
+
+
+def _task_names(dataset):
+    return [name[len(dataset) + 1:] for name in TASK_PARAMS if name.startswith(f'{dataset}-')]
+
+
+def build_dag(datasets, train=True, use_store=False, subsample=0):
+    """ Nodes of the nightly run: db_setup (for missing databases) -> derived tables -> feature SQL
+    per task and split -> training, keyed by node id.
+
+    Nodes that touch a dataset's database hold its lock in `access` mode: 'write' nodes run alone,
+    'read' nodes (feature generation into the feature store, read-only training) run together.
+    """
+    python = sys.executable
+    nodes = {}
+
+    def add(node_id, kind, cmd, deps, dataset, access):
+        nodes[node_id] = dict(
+            id=node_id, kind=kind, cmd=cmd, deps=[d for d in deps if d in nodes],
+            dataset=dataset, access=access,
+        )
+
+    for dataset in datasets:
+        db_filename = DATASET_TO_DB[dataset]
+        if not os.path.exists(os.path.join(ROOT, db_filename)):
+            add(
+                f'{dataset}/db_setup', 'db_setup',
+                [python, '-c', f'import utils; utils.db_setup({dataset!r}, {db_filename!r})'],
+                [], dataset, 'write',
+            )
+        if utils.DATASET_INFO[dataset].get('derived_tables'):
+            add(
+                f'{dataset}/derived', 'derived',
+                [python, 'nightly.py', '--node', 'derived', '--dataset', dataset],
+                [f'{dataset}/db_setup'], dataset, 'write',
+            )
+        for task in _task_names(dataset):
+            feats_nodes = []
+            for split in ['train', 'val', 'test']:
+                node_id = f'{dataset}-{task}/feats/{split}'
+                cmd = [
+                    python, 'nightly.py', '--node', 'feats', '--dataset', dataset, '--task', task,
+                    '--split', split, '--subsample', str(subsample),
+                ]
+                if use_store:
+                    cmd.append('--feature_store')
+                add(
+                    node_id, 'feats', cmd, [f'{dataset}/db_setup', f'{dataset}/derived'], dataset,
+                    'read' if use_store else 'write',
+                )
+                feats_nodes.append(node_id)
+            if train:
+                cmd = [python, 'train_gbdt.py', '--dataset', dataset, '--task', task]
+                if subsample > 0:
+                    cmd += ['--subsample', str(subsample)]
+                if use_store:
+                    cmd += ['--feature_store', '--read_only']
+                add(
+                    f'{dataset}-{task}/train', 'train', cmd, feats_nodes, dataset,
+                    'read' if use_store else 'write',
+                )
+    return nodes
+
+
+def load_history():
+    if not os.path.exists(HISTORY_PATH):
+        return {}
+    with open(HISTORY_PATH) as f:
+        return json.load(f)
+
+
+def save_history(history):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp_path = f'{HISTORY_PATH}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f, indent=2)
+    os.replace(tmp_path, HISTORY_PATH)
+
+
+def estimate(node, history, max_memory_mb, max_threads, predictions=None):
+    """ (memory MB, threads, wall seconds) needed by a node, from its last successful runs, or from
+    its cost model prediction (see estimate_feats.py) if it never ran. """
+    runs = [r for r in history.get(node['id'], []) if r['status'] == 'ok'][-HISTORY_RUNS:]
+    pred = (predictions or {}).get(node['id'])
+    if not runs and pred is not None:
+        memory_mb = MEMORY_PADDING * pred['peak_rss_mb']
+        threads = DEFAULT_THREADS[node['kind']]
+        wall_s = pred['wall_s']
+    elif not runs:
+        memory_mb = DEFAULT_MEMORY_MB[node['kind']]
+        threads = DEFAULT_THREADS[node['kind']]
+        wall_s = DEFAULT_WALL_S[node['kind']]
+    else:
+        memory_mb = MEMORY_PADDING * max(r['peak_rss_mb'] for r in runs)
+        # effective parallelism: cpu seconds per wall second
+        threads = math.ceil(max(r['cpu_s'] / max(r['wall_s'], 1e-3) for r in runs))
+        wall_s = max(r['wall_s'] for r in runs)
+    return min(memory_mb, max_memory_mb), max(1, min(threads, max_threads)), wall_s
+
+
+def _critical_paths(nodes, wall_s):
+    """ Estimated wall time of the longest chain of nodes starting at each node. """
+    children = {node_id: [] for node_id in nodes}
+    for node in nodes.values():
+        for dep in node['deps']:
+            children[dep].append(node['id'])
+    paths = {}
+
+    def path(node_id):
+        if node_id not in paths:
+            paths[node_id] = wall_s[node_id] + max((path(c) for c in children[node_id]), default=0)
+        return paths[node_id]
+
+    for node_id in nodes:
+        path(node_id)
+    return paths
+
+
+def _rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def _log_oom(log_path):
+    """ Whether a node's log shows it ran out of memory. """
+    with open(log_path, errors='replace') as f:
+        tail = f.read()[-20_000:]
+    return 'MemoryError' in tail or 'OutOfMemoryException' in tail or 'Out of Memory' in tail
+
+
+def run_dag(nodes, max_memory_mb, max_threads, dry_run=False, predictions=None):
+    """ Runs the nodes as subprocesses, as many at a time as fit in memory and threads.
+
+    Ready nodes are started longest critical path first, whenever their estimated memory and
+    threads fit in what the running nodes leave free (a node always starts if nothing else runs).
+    If the running nodes' RSS exceeds max_memory_mb, the node furthest over its estimate is killed.
+    Nodes that run out of memory are retried with a larger reservation, half the threads and a
+    duckdb memory limit below it, so that duckdb spills to disk instead.
+
+    Returns the ids of the nodes that failed (or were skipped because a dependency failed).
+    """
+    history = load_history()
+    predictions = predictions or {}
+    est = {
+        node_id: estimate(node, history, max_memory_mb, max_threads, predictions)
+        for node_id, node in nodes.items()
+    }
+    paths = _critical_paths(nodes, {node_id: e[2] for node_id, e in est.items()})
+    limits = {node_id: dict(memory_mb=e[0], threads=e[1]) for node_id, e in est.items()}
+    # nodes predicted not to fit start with the limits of an out of memory retry right away
+    for node_id in sorted(nodes):
+        pred = predictions.get(node_id)
+        ran = any(r['status'] == 'ok' for r in history.get(node_id, []))
+        if pred is not None and not ran and pred['peak_rss_mb'] > max_memory_mb:
+            print(
+                f'Warning: {node_id} is predicted to need {pred["peak_rss_mb"]:,.0f} MB, starting '
+                'it with a duckdb memory limit so that it spills to disk.'
+            )
+            limits[node_id]['duckdb_memory_mb'] = 0.6 * limits[node_id]['memory_mb']
+    if dry_run:
+        print(f'{"node":<45}{"memory (MB)":>12}{"threads":>9}{"path (s)":>10}  deps')
+        for node_id in sorted(nodes, key=lambda n: -paths[n]):
+            print(
+                f'{node_id:<45}{limits[node_id]["memory_mb"]:>12,.0f}'
+                f'{limits[node_id]["threads"]:>9}{paths[node_id]:>10,.0f}  '
+                f'{", ".join(nodes[node_id]["deps"])}'
+            )
+        return []
+
+    log_dir = os.path.join(STATE_DIR, 'logs', f'{datetime.datetime.now():%Y%m%dT%H%M%S}')
+    os.makedirs(log_dir, exist_ok=True)
+    pending = set(nodes)
+    done, failed = set(), set()
+    attempts = {node_id: 0 for node_id in nodes}
+    running = {}
+    while pending or running:
+        # start ready nodes
+        used_mb = sum(limits[n]['memory_mb'] for n in running)
+        used_threads = sum(limits[n]['threads'] for n in running)
+        for node_id in sorted(pending, key=lambda n: -paths[n]):
+            node = nodes[node_id]
+            if any(d in failed for d in node['deps']):
+                print(f'Skipping {node_id}: a dependency failed.')
+                pending.discard(node_id)
+                failed.add(node_id)
+                continue
+            if not all(d in done for d in node['deps']):
+                continue
+            # readers of a dataset's db can run together, writers run alone
+            db_users = [
+                nodes[n]['access'] for n in running if nodes[n]['dataset'] == node['dataset']
+            ]
+            if 'write' in db_users or (db_users and node['access'] == 'write'):
+                continue
+            limit = limits[node_id]
+            fits = (
+                used_mb + limit['memory_mb'] <= max_memory_mb
+                and used_threads + limit['threads'] <= max_threads
+            )
+            if running and not fits:
+                continue
+            attempts[node_id] += 1
+            log_path = os.path.join(log_dir, f'{node_id.replace("/", "_")}.{attempts[node_id]}.log')
+            cmd = list(node['cmd'])
+            if node['kind'] in ('derived', 'feats'):
+                cmd += ['--threads', str(limit['threads'])]
+                if 'duckdb_memory_mb' in limit:
+                    cmd += ['--memory_limit_mb', str(int(limit['duckdb_memory_mb']))]
+            env = {**os.environ, 'OMP_NUM_THREADS': str(limit['threads'])}
+            with open(log_path, 'w') as log:
+                proc = subprocess.Popen(
+                    cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+                    start_new_session=True,
+                )
+            print(
+                f'Started {node_id} (attempt {attempts[node_id]}, {limit["memory_mb"]:,.0f} MB, '
+                f'{limit["threads"]} threads).'
+            )
+            running[node_id] = dict(proc=proc, start=time.time(), log=log_path, killed=False)
+            pending.discard(node_id)
+            used_mb += limit['memory_mb']
+            used_threads += limit['threads']
+
+        time.sleep(POLL_SECONDS)
+
+        # enforce the memory budget
+        rss = {n: _rss_mb(r['proc'].pid) for n, r in running.items() if not r['killed']}
+        if rss and sum(rss.values()) > max_memory_mb:
+            victim = max(rss, key=lambda n: rss[n] - limits[n]['memory_mb'])
+            print(f'Memory budget exceeded, killing {victim} ({rss[victim]:,.0f} MB).')
+            os.killpg(running[victim]['proc'].pid, signal.SIGKILL)
+            running[victim]['killed'] = True
+
+        # collect finished nodes
+        for node_id, run in list(running.items()):
+            pid, status, usage = os.wait4(run['proc'].pid, os.WNOHANG)
+            if pid == 0:
+                continue
+            run['proc'].returncode = os.waitstatus_to_exitcode(status)
+            del running[node_id]
+            wall_s = time.time() - run['start']
+            code = run['proc'].returncode
+            oom = run['killed'] or code in (-signal.SIGKILL, OOM_EXIT_CODE) or _log_oom(run['log'])
+            status_name = 'ok' if code == 0 else 'oom' if oom else 'error'
+            history.setdefault(node_id, []).append(dict(
+                date=datetime.datetime.now().isoformat(), status=status_name,
+                peak_rss_mb=usage.ru_maxrss / 1024, cpu_s=usage.ru_utime + usage.ru_stime,
+                wall_s=wall_s, threads=limits[node_id]['threads'],
+            ))
+            save_history(history)
+            if code == 0:
+                print(f'Finished {node_id} in {wall_s:,.0f} seconds.')
+                done.add(node_id)
+            elif oom and attempts[node_id] < MAX_ATTEMPTS:
+                limit = limits[node_id]
+                limit['memory_mb'] = min(
+                    max_memory_mb, max(limit['memory_mb'], usage.ru_maxrss / 1024)
+                )
+                limit['threads'] = max(1, limit['threads'] // 2)
+                limit['duckdb_memory_mb'] = 0.6 * limit['memory_mb']
+                print(f'{node_id} ran out of memory, retrying with tighter limits.')
+                pending.add(node_id)
+            else:
+                print(f'{node_id} failed with exit code {code}, see "{run["log"]}".')
+                failed.add(node_id)
+    return sorted(failed)
+
+
+def _connect(db_filename, memory_limit_mb=None, threads=None, read_only=False):
+    conn = duckdb.connect(db_filename, read_only=read_only)
+    if memory_limit_mb is not None:
+        conn.sql(f"set memory_limit = '{memory_limit_mb}MB'")
+    if threads is not None:
+        conn.sql(f'set threads = {threads}')
+    return conn
+
+
+def run_node(args):
+    """ Runs a single derived tables / feature generation node (called by run_dag). """
+    db_filename = DATASET_TO_DB[args.dataset]
+    if args.node == 'derived':
+        conn = _connect(db_filename, args.memory_limit_mb, args.threads)
+        utils.create_derived_tables(args.dataset, conn)
+        conn.close()
+        return
+    task_params = TASK_PARAMS[f'{args.dataset}-{args.task}']
+    with open(os.path.join(task_params['dir'], 'feats.sql')) as f:
+        template = f.read()
+    query = utils.render_jinja_sql(template, dict(set=args.split, subsample=args.subsample))
+    conn = _connect(db_filename, args.memory_limit_mb, args.threads, read_only=args.feature_store)
+    if args.feature_store:
+        table_name = f'{task_params["table_prefix"]}_{args.split}_feats'
+        meta = feature_store.write_version(
+            conn, query, os.path.join(task_params['dir'], 'feature_store'), table_name,
+            subsample=args.subsample,
+        )
+        print(f'Stored {table_name} version {meta["version"]} ({meta["num_rows"]:,} rows).')
+    else:
+        conn.sql(query)
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=(
+            'Rebuild features (and retrain models) for several datasets, running as many steps at '
+            'once as fit in memory.'
+        )
+    )
+    parser.add_argument('--datasets', nargs='+', default=list(DATASET_TO_DB),
+                        help='Relbench dataset names')
+    parser.add_argument('--no_train', action='store_true', help='Only generate features')
+    parser.add_argument('--feature_store', action='store_true',
+                        help=(
+                            'Write features to the feature store (see feature_store.py), so that '
+                            'the tasks of a dataset can generate features and train concurrently.'
+                        ))
+    parser.add_argument('--subsample', '-s', type=int, default=0, help='Train subsample size')
+    parser.add_argument('--memory_mb', type=float, default=None,
+                        help='Memory budget (defaults to 80%% of the physical memory)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Thread budget (defaults to the number of CPUs), or of a single node')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Print the nodes with their estimated needs without running them')
+    # used by run_dag to run single nodes
+    parser.add_argument('--node', choices=['derived', 'feats'], default=None,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--dataset', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--task', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--split', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--memory_limit_mb', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.node is not None:
+        try:
+            run_node(args)
+        except (MemoryError, duckdb.OutOfMemoryException) as e:
+            print(f'{type(e).__name__}: {e}')
+            sys.exit(OOM_EXIT_CODE)
+        sys.exit(0)
+
+    max_memory_mb = args.memory_mb or (
+        0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**20
+    )
+    max_threads = args.threads or os.cpu_count()
+    nodes = build_dag(
+        args.datasets, train=not args.no_train, use_store=args.feature_store,
+        subsample=args.subsample,
+    )
+    print(f'{len(nodes)} nodes, {max_memory_mb:,.0f} MB and {max_threads} threads available.')
+    failed = run_dag(
+        nodes, max_memory_mb, max_threads, dry_run=args.dry_run,
+        predictions=estimate_feats.load_predictions(args.subsample),
+    )
+    if failed:
+        print(f'{len(failed)} nodes failed: {", ".join(failed)}')
+        sys.exit(1)
@@ -0,0 +1,81 @@
+import argparse
+import os
+import time
+
+import duckdb
+import sqlglot
+from sqlglot import exp
+
+from inferred_stypes import task_to_stypes
+from train_gbdt import DATASET_TO_DB, TASK_PARAMS
+import utils
+
+
+def time_query(conn, query, table_name='_prune_timing', keep=False):
+    """ Runs a feats.sql query into a temp table (so existing feature tables aren't overwritten)
+    and returns the elapsed seconds. The temp table is dropped unless keep is set. """
+    tree = sqlglot.parse_one(query, read='duckdb')
+    tree.set('this', exp.to_table(table_name))
+    tree.set('properties', exp.Properties(expressions=[exp.TemporaryProperty()]))
+    start = time.time()
+    conn.sql(utils.to_duckdb_sql(tree))
+    elapsed = time.time() - start
+    if not keep:
+        conn.sql(f'drop table {table_name}')
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Prune the feats.sql of a task down to the columns that are actually used.'
+    )
+    parser.add_argument('--dataset', '-d', type=str, help='Relbench dataset name')
+    parser.add_argument('--task', '-t', type=str, help='Relbench task name')
+    parser.add_argument('--drop_cols', nargs='+', default=[], help='Columns to drop')
+    parser.add_argument('--min_shap_pct', type=float, default=None,
+                        help=(
+                            'If provided, also drop features whose share of mean |SHAP| in '
+                            '<table_prefix>_feature_importance (see train_gbdt.py --importance) is '
+                            'below this value.'
+                        ))
+    parser.add_argument('--set', type=str, default='val', help='Split used to time both queries')
+    parser.add_argument('--subsample', '-s', type=int, default=0,
+                        help='Train subsample size used when rendering (only used if --set=train)')
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='Where to write the pruned (rendered) query. Printed if not given.')
+    args = parser.parse_args()
+    full_task_name = f'{args.dataset}-{args.task}'
+    task_params = TASK_PARAMS[full_task_name]
+    conn = duckdb.connect(DATASET_TO_DB[args.dataset])
+
+    drop_cols = set(args.drop_cols)
+    if args.min_shap_pct is not None:
+        importance = conn.sql(
+            f'select feature from {task_params["table_prefix"]}_feature_importance '
+            f'where shap_pct < {args.min_shap_pct}'
+        ).fetchall()
+        drop_cols |= {f for f, in importance}
+    drop_cols -= set(task_params['identifier_cols'] + [task_params['target_col']])
+    keep_cols = [c for c in task_to_stypes[full_task_name] if c not in drop_cols]
+    print(f'Dropping {len(drop_cols):,} columns, keeping {len(keep_cols):,}.')
+
+    with open(os.path.join(task_params['dir'], 'feats.sql')) as f:
+        template = f.read()
+    query = utils.render_jinja_sql(template, dict(set=args.set, subsample=args.subsample))
+    pruned = utils.prune_query(query, keep_cols, conn=conn)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(pruned + '\n')
+        print(f'Pruned query written to "{args.output}".')
+    else:
+        print(pruned)
+    print()
+
+    print(f'Timing original and pruned queries on the {args.set} split.')
+    original_time = time_query(conn, query)
+    print(f'Original: {original_time:,.1f} seconds.')
+    pruned_time = time_query(conn, pruned)
+    print(f'Pruned: {pruned_time:,.1f} seconds.')
+    saved = original_time - pruned_time
+    print(f'Time saved: {saved:,.1f} seconds ({saved / max(original_time, 1e-9):.0%}).')
+    conn.close()
@@ -0,0 +1,163 @@
+import math
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import duckdb
+import sqlglot
+from sqlglot import exp
+
+import utils
+
+
+def shard_subsample(subsample: int, num_shards: int) -> int:
+    """ Per-shard train subsample size, so that the shards add up to (about) subsample rows. """
+    return math.ceil(subsample / num_shards) if subsample > 0 else 0
+
+
+def _equal_columns(tree: exp.Expression, col: str) -> set:
+    """ Names of the columns that equality conditions anywhere in tree (transitively) equate to col,
+    eg: OwnerUserId for UserId after `labels.UserId = posts.OwnerUserId`. """
+    equal = {col.lower()}
+    pairs = [
+        (eq.left.name.lower(), eq.right.name.lower()) for eq in tree.find_all(exp.EQ)
+        if isinstance(eq.left, exp.Column) and isinstance(eq.right, exp.Column)
+    ]
+    size = 0
+    while size != len(equal):
+        size = len(equal)
+        for left, right in pairs:
+            if left in equal or right in equal:
+                equal |= {left, right}
+    return equal
+
+
+def cross_entity_windows(query: str, label_table: str, entity_col: str) -> list:
+    """ Window functions of a rendered feats.sql query that mix label rows of different entities.
+
+    Sharding is only correct if the features of a label row only depend on label rows of the same
+    entity. This flags windows (eg: `avg(x) over ()`) in selects that read from label_table or from
+    CTEs derived from it, unless they are partitioned by entity_col (or a column equated to it).
+    """
+    tree = sqlglot.parse_one(query, read='duckdb')
+    derived = {label_table.lower()}
+    selects = []
+    for cte in tree.find_all(exp.CTE):
+        tables = {t.name.lower() for t in cte.this.find_all(exp.Table)}
+        if tables & derived:
+            derived.add(cte.alias_or_name.lower())
+            selects.append(cte.this)
+    body = tree.expression if isinstance(tree, exp.Create) else tree
+    selects.append(body)
+    entity_cols = _equal_columns(tree, entity_col)
+    offending = []
+    for select in selects:
+        for window in select.find_all(exp.Window):
+            # only windows of selects that read label-derived relations themselves
+            scope = window.find_ancestor(exp.Select)
+            tables = {t.name.lower() for t in scope.find_all(exp.Table)} if scope else set()
+            if not tables & derived:
+                continue
+            if isinstance(window.this, exp.Identifier):
+                continue  # a named window definition, checked through the windows using it
+            partition_by = window.args.get('partition_by')
+            if not partition_by and window.args.get('alias') is not None:
+                # `over <name>`: use the definition in the select's window clause
+                name = window.args['alias'].name
+                for definition in scope.args.get('windows') or []:
+                    if definition.this.name == name:
+                        partition_by = definition.args.get('partition_by')
+            partition = {c.name.lower() for p in partition_by or [] for c in p.find_all(exp.Column)}
+            if not partition & entity_cols:
+                offending.append(window.sql(dialect='duckdb'))
+    return list(dict.fromkeys(offending))
+
+
+def _run_shard(db_filename, query, label_table, entity_col, shard, num_shards, path, threads):
+    """ Runs query on the label rows of one shard and writes the result to path. Returns
+    (rows, seconds, peak RSS in MB) of the worker. """
+    start = time.time()
+    conn = utils.read_connection(db_filename, snapshot=False)
+    if threads is not None:
+        conn.sql(f'set threads = {threads}')
+    catalog, = conn.sql('select current_database()').fetchone()
+    # shadow the label table with this shard's rows, so the query only sees them
+    conn.sql(f"""
+        create temp view {label_table} as
+        select * from {catalog}.main.{label_table}
+        where hash("{entity_col}") % {num_shards} = {shard}
+    """)
+    utils.copy_to_parquet(conn, query, path)
+    rows, = conn.sql(f"select count(*) from read_parquet('{path}')").fetchone()
+    conn.close()
+    return rows, time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_sharded(
+    db_filename: str,
+    query: str,
+    label_table: str,
+    entity_col: str,
+    num_shards: int,
+    out_dir: str,
+    max_workers: int = None,
+) -> list:
+    """ Runs a rendered feats.sql query in worker processes, each on a hash partition of the labels.
+
+    Every worker attaches db_filename read-only (so it must not be open read-write elsewhere, eg:
+    pass a snapshot, see utils.publish_snapshot) and shadows label_table with a temp view of the
+    label rows whose entity_col hashes to its shard, so its peak memory is roughly that of the
+    query on 1 / num_shards of the labels. This is only correct if the features of a label row
+    only depend on label rows of the same entity, which is the case for the feats.sql files here.
+    Each shard is written to out_dir/shard_<i>.parquet, and the paths are returned.
+    """
+    offending = cross_entity_windows(query, label_table, entity_col)
+    if offending:
+        raise ValueError(
+            f'Can\'t shard this query by {entity_col}, these windows mix label rows of different '
+            f'entities: {offending}'
+        )
+    max_workers = min(max_workers or num_shards, num_shards)
+    threads = max(1, (os.cpu_count() or 1) // max_workers)
+    paths = [os.path.join(out_dir, f'shard_{i}.parquet') for i in range(num_shards)]
+    # duckdb isn't fork safe
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+        futures = [
+            pool.submit(
+                _run_shard, os.path.abspath(db_filename), query, label_table, entity_col, i,
+                num_shards, paths[i], threads,
+            ) for i in range(num_shards)
+        ]
+        for i, future in enumerate(futures):
+            rows, seconds, peak_rss_mb = future.result()
+            print(
+                f'Shard {i + 1}/{num_shards}: {rows:,} rows in {seconds:,.1f} seconds '
+                f'(worker peak RSS {peak_rss_mb:,.0f} MB).'
+            )
+    return paths
+
+
+def concat_shards(conn: duckdb.DuckDBPyConnection, paths: list, path: str):
+    """ Concatenates shard Parquet files into a single Parquet file. """
+    files = ', '.join(f"'{p}'" for p in paths)
+    conn.sql(f"copy (select * from read_parquet([{files}])) to '{path}' (format parquet)")
+
+
+def write_sharded(
+    conn: duckdb.DuckDBPyConnection,
+    db_filename: str,
+    query: str,
+    label_table: str,
+    entity_col: str,
+    num_shards: int,
+    path: str,
+):
+    """ Runs a rendered feats.sql query in num_shards worker processes (see run_sharded) and writes
+    the concatenated result to a single Parquet file at path. """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp_dir:
+        paths = run_sharded(db_filename, query, label_table, entity_col, num_shards, tmp_dir)
+        concat_shards(conn, paths, path)
@@ -0,0 +1,75 @@
+-- Running per-post vote and comment counts, one row per (post, time of a vote or comment). ASOF
+-- joining on `ts > CreationDate` gives a post's counts as of any point in time ts, instead of
+-- joining and re-aggregating every earlier vote and comment of the post for each label timestamp.
+-- Reads comments.TextNumWords (see text_stats.sql).
+create or replace table post_activity_history as -- noqa
+
+with first_comments as (
+    select
+        PostId,
+        CreationDate,
+        TextNumWords,
+        -- first comment of each commenter on the post, to count distinct commenters
+        UserId is not null and row_number() over (
+            partition by PostId, UserId
+            order by CreationDate asc
+        ) = 1 as is_first_by_user
+    from comments
+),
+
+events as (
+    select
+        PostId,
+        CreationDate,
+        count(*) as num_votes,
+        count(case when VoteTypeId in (1, 2, 5, 8, 16) then 1 end) as num_positive_votes,
+        count(case when VoteTypeId in (3, 4, 6, 10, 12) then 1 end) as num_negative_votes,
+        0 as num_comments,
+        0 as sum_comment_words,
+        0 as num_new_commenters
+    from votes
+    group by PostId, CreationDate
+    union all
+    select
+        PostId,
+        CreationDate,
+        0 as num_votes,
+        0 as num_positive_votes,
+        0 as num_negative_votes,
+        count(*) as num_comments,
+        sum(coalesce(TextNumWords, 0)) as sum_comment_words,
+        count(case when is_first_by_user then 1 end) as num_new_commenters
+    from first_comments
+    group by PostId, CreationDate
+),
+
+events_by_time as (
+    select
+        PostId,
+        CreationDate,
+        sum(num_votes) as num_votes,
+        sum(num_positive_votes) as num_positive_votes,
+        sum(num_negative_votes) as num_negative_votes,
+        sum(num_comments) as num_comments,
+        sum(sum_comment_words) as sum_comment_words,
+        sum(num_new_commenters) as num_new_commenters
+    from events
+    group by PostId, CreationDate
+)
+
+select
+    PostId,
+    CreationDate,
+    (sum(num_votes) over running_total)::uinteger as num_votes,
+    (sum(num_positive_votes) over running_total)::uinteger as num_positive_votes,
+    (sum(num_negative_votes) over running_total)::uinteger as num_negative_votes,
+    (sum(num_comments) over running_total)::uinteger as num_comments,
+    (sum(sum_comment_words) over running_total)::ubigint as sum_comment_words,
+    (sum(num_new_commenters) over running_total)::uinteger as num_distinct_commenters
+from events_by_time
+window running_total as (
+    partition by PostId
+    order by CreationDate asc
+    rows between unbounded preceding and current row
+)
+order by PostId, CreationDate
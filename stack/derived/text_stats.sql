@@ -0,0 +1,22 @@
+-- Word and tag counts of the stack text columns, stored as integer columns next to the text so
+-- feats.sql never splits large text blobs for each (label, post) or (label, comment) row it joins.
+-- A count of separators + 1 equals len(string_split(x, sep)) without building the list of parts
+-- (null for null text, 1 for empty text). Free text (bodies, about-me, comments) has no length
+-- limit, so its counts are uinteger; the alter column widens counts stored by earlier runs.
+alter table posts add column if not exists NumTags utinyint;
+alter table posts add column if not exists TitleNumWords usmallint;
+alter table posts add column if not exists BodyNumWords uinteger;
+update posts set
+    NumTags = (length(trim(Tags, '<>')) - length(replace(trim(Tags, '<>'), '><', ''))) // 2 + 1,
+    TitleNumWords = length(Title) - length(replace(Title, ' ', '')) + 1,
+    BodyNumWords = length(Body) - length(replace(Body, ' ', '')) + 1;
+
+alter table users add column if not exists AboutMeNumWords uinteger;
+alter table users alter column AboutMeNumWords type uinteger;
+update users set
+    AboutMeNumWords = length(AboutMe) - length(replace(AboutMe, ' ', '')) + 1;
+
+alter table comments add column if not exists TextNumWords uinteger;
+alter table comments alter column TextNumWords type uinteger;
+update comments set
+    TextNumWords = length(Text) - length(replace(Text, ' ', '')) + 1;
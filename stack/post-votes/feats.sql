@@ -83,19 +83,6 @@ post_ordinals as (
     from posts
 ),
 
-num_votes as (
-    select
-        labels.PostId,
-        labels.timestamp,
-        count(*) as num_votes
-    from labels
-    left join votes
-        on
-            labels.PostId = votes.PostId
-            and labels.timestamp > votes.CreationDate
-    group by all
-),
-
 vote_stats_first_month as (
     select
         votes.PostId,
@@ -179,10 +166,11 @@ post_feats as (
         date_diff('week', posts.CreationDate, labels.timestamp) as post_age_weeks,
         coalesce(len(post_attrs_at_creation.orig_title), 0) as title_length,
         coalesce(len(post_attrs_at_creation.orig_body), 0) as body_length,
-        coalesce(len(string_split(trim(posts.Tags, '<>'), '><')), 0) as num_tags,
+        coalesce(posts.NumTags, 0) as num_tags,
         date_diff('month', users.CreationDate, labels.timestamp) as user_age_months,
         post_ordinals.post_ordinal,
-        num_votes.num_votes,
+        -- posts without earlier votes count as 1 (see stack/derived/post_activity_history.sql)
+        greatest(coalesce(post_activity.num_votes, 0), 1) as num_votes,
         post_hist_feats.closed_weeks_ago,
         post_hist_feats.reopened_weeks_ago,
         post_hist_feats.deleted_weeks_ago,
@@ -204,10 +192,6 @@ post_feats as (
         on posts.OwnerUserId = users.Id
     left join post_ordinals
         on labels.PostId = post_ordinals.PostId
-    left join num_votes
-        on
-            labels.PostId = num_votes.PostId
-            and labels.timestamp = num_votes.timestamp
     left join post_hist_feats
         on
             labels.PostId = post_hist_feats.PostId
@@ -216,6 +200,10 @@ post_feats as (
         on
             posts.OwnerUserId = owner_feats_by_timestamp.user_id
             and labels.timestamp = owner_feats_by_timestamp.timestamp
+    asof left join post_activity_history as post_activity
+        on
+            labels.PostId = post_activity.PostId
+            and labels.timestamp > post_activity.CreationDate
 )
 
 -- Final Feature Set
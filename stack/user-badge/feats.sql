@@ -35,7 +35,7 @@ badge_feats_deagged as (
             badges.Date
         ) as weeks_since_prev_badge,
         -- exponential decay results in ~6% of original weight after 1 year
-        (rarity * 0.95**badge_age_weeks) as smoothed_weight
+        (rarity * pow(0.95, badge_age_weeks)) as smoothed_weight
     from labels
     left join badges
         on
@@ -81,7 +81,7 @@ comment_aggs_by_user as (
         min(date_diff('week', comments.CreationDate, labels.timestamp)) as weeks_since_last_comment,
         count(distinct comments.Id) as num_comments,
         count(distinct comments.PostId) as num_posts_commented,
-        avg(coalesce(len(string_split(comments.Text, ' ')), 0)) as avg_comment_length
+        avg(coalesce(comments.TextNumWords, 0)) as avg_comment_length
     from labels
     left join comments
         on
@@ -103,27 +103,11 @@ post_labels as (
             and labels.timestamp > posts.CreationDate
 ),
 
-vote_aggs as (
-    select
-        post_labels.UserId,
-        post_labels.timestamp,
-        post_labels.post_id,
-        count(case when votes.VoteTypeId in (1, 2, 5, 8, 16) then 1 end) as num_positive_votes,
-        count(case when votes.VoteTypeId in (3, 4, 6, 10, 12) then 1 end) as num_negative_votes
-    from post_labels
-    left join votes
-        on
-            post_labels.post_id = votes.PostId
-            and post_labels.timestamp > votes.CreationDate
-    group by all
-),
-
 comment_aggs_by_post as (
     select
         post_labels.post_id,
         post_labels.UserId,
         post_labels.timestamp,
-        count(distinct comments.Id) as num_comments,
         avg(coalesce(badge_feats.badge_score, 0)) as avg_badge_score
     from post_labels
     left join comments
@@ -148,8 +132,8 @@ post_feats_deagged as (
             order by posts.CreationDate desc
         ) as post_rank,
         posts.PostTypeId as post_type,
-        coalesce(len(string_split(trim(posts.Tags, '<>'), '><')), 0) as num_tags,
-        len(string_split(posts.Body, ' ')) as body_length,
+        coalesce(posts.NumTags, 0) as num_tags,
+        posts.BodyNumWords as body_length,
         date_diff(
             'days',
             lag(posts.CreationDate, 1) over (
@@ -157,23 +141,24 @@ post_feats_deagged as (
             ),
             posts.CreationDate
         ) as days_since_last_post,
-        coalesce(vote_aggs.num_positive_votes, 0) as num_positive_votes,
-        coalesce(vote_aggs.num_negative_votes, 0) as num_negative_votes,
-        coalesce(comment_aggs_by_post.num_comments, 0) as num_comments,
+        coalesce(post_activity.num_positive_votes, 0) as num_positive_votes,
+        coalesce(post_activity.num_negative_votes, 0) as num_negative_votes,
+        coalesce(post_activity.num_comments, 0) as num_comments,
         comment_aggs_by_post.avg_badge_score as avg_commenter_badge_score
     from post_labels
     left join posts
         on post_labels.post_id = posts.Id
-    left join vote_aggs
-        on
-            post_labels.post_id = vote_aggs.post_id
-            and post_labels.UserId = vote_aggs.UserId
-            and post_labels.timestamp = vote_aggs.timestamp
     left join comment_aggs_by_post
         on
             post_labels.post_id = comment_aggs_by_post.post_id
             and post_labels.UserId = comment_aggs_by_post.UserId
             and post_labels.timestamp = comment_aggs_by_post.timestamp
+    -- vote and comment counts of the post as of the label timestamp (see
+    -- stack/derived/post_activity_history.sql)
+    asof left join post_activity_history as post_activity
+        on
+            post_labels.post_id = post_activity.PostId
+            and post_labels.timestamp > post_activity.CreationDate
 ),
 
 last_question_feats as (
@@ -39,7 +39,7 @@ user_feats as (
         date_diff('month', users.CreationDate, labels.timestamp) as months_since_account_creation,
         (users.DisplayName is null) as display_name_is_null,
         (users.WebsiteUrl is null) as website_url_is_null,
-        coalesce(len(string_split(users.AboutMe, ' ')), 0) as about_me_length,
+        coalesce(users.AboutMeNumWords, 0) as about_me_length,
         (users.Location is null) as location_is_null
     from labels
     left join users
@@ -53,7 +53,7 @@ comment_aggs_by_user as (
         min(date_diff('week', comments.CreationDate, labels.timestamp)) as weeks_since_last_comment,
         count(distinct comments.Id) as num_comments,
         count(distinct comments.PostId) as num_posts_commented,
-        avg(coalesce(len(string_split(comments.Text, ' ')), 0)) as avg_comment_length
+        avg(coalesce(comments.TextNumWords, 0)) as avg_comment_length
     from labels
     left join comments
         on
@@ -75,29 +75,11 @@ post_labels as (
             and labels.timestamp > posts.CreationDate
 ),
 
-vote_aggs as (
-    select
-        post_labels.OwnerUserId,
-        post_labels.timestamp,
-        post_labels.post_id,
-        count(case when votes.VoteTypeId in (1, 2, 5, 8, 16) then 1 end) as num_positive_votes,
-        count(case when votes.VoteTypeId in (3, 4, 6, 10, 12) then 1 end) as num_negative_votes
-    from post_labels
-    left join votes
-        on
-            post_labels.post_id = votes.PostId
-            and post_labels.timestamp > votes.CreationDate
-    group by all
-),
-
 comment_aggs_by_post as (
     select
         post_labels.post_id,
         post_labels.OwnerUserId,
         post_labels.timestamp,
-        count(distinct comments.Id) as num_comments,
-        avg(coalesce(len(string_split(comments.Text, ' ')), 0)) as avg_comment_length,
-        count(distinct comments.UserId) as num_distinct_users,
         avg(coalesce(badge_feats.badge_score, 0)) as avg_badge_score
     from post_labels
     left join comments
@@ -130,9 +112,9 @@ post_feats_deagged as (
         posts.PostTypeId as post_type,
         (posts.AcceptedAnswerId is not null) as has_accepted_ans,
         (accepted_answers.accepted_ans_id is not null) as is_accepted_ans,
-        coalesce(len(string_split(trim(posts.Tags, '<>'), '><')), 0) as num_tags,
-        len(string_split(posts.Title, ' ')) as title_length,
-        len(string_split(posts.Body, ' ')) as body_length,
+        coalesce(posts.NumTags, 0) as num_tags,
+        posts.TitleNumWords as title_length,
+        posts.BodyNumWords as body_length,
         date_diff(
             'days',
             lag(posts.CreationDate, 1) over (
@@ -140,27 +122,30 @@ post_feats_deagged as (
             ),
             posts.CreationDate
         ) as days_since_last_post,
-        coalesce(vote_aggs.num_positive_votes, 0) as num_positive_votes,
-        coalesce(vote_aggs.num_negative_votes, 0) as num_negative_votes,
-        coalesce(comment_aggs_by_post.num_comments, 0) as num_comments,
-        coalesce(comment_aggs_by_post.avg_comment_length, 0) as avg_comment_length,
-        coalesce(comment_aggs_by_post.num_distinct_users, 0) as num_distinct_commenters,
+        coalesce(post_activity.num_positive_votes, 0) as num_positive_votes,
+        coalesce(post_activity.num_negative_votes, 0) as num_negative_votes,
+        coalesce(post_activity.num_comments, 0) as num_comments,
+        coalesce(
+            post_activity.sum_comment_words / nullif(post_activity.num_comments, 0), 0
+        ) as avg_comment_length,
+        coalesce(post_activity.num_distinct_commenters, 0) as num_distinct_commenters,
         comment_aggs_by_post.avg_badge_score as avg_commenter_badge_score
     from post_labels
     left join posts
         on post_labels.post_id = posts.Id
     left join accepted_answers
         on post_labels.post_id = accepted_answers.accepted_ans_id
-    left join vote_aggs
-        on
-            post_labels.post_id = vote_aggs.post_id
-            and post_labels.OwnerUserId = vote_aggs.OwnerUserId
-            and post_labels.timestamp = vote_aggs.timestamp
     left join comment_aggs_by_post
         on
             post_labels.post_id = comment_aggs_by_post.post_id
             and post_labels.OwnerUserId = comment_aggs_by_post.OwnerUserId
             and post_labels.timestamp = comment_aggs_by_post.timestamp
+    -- vote and comment counts of the post as of the label timestamp (see
+    -- stack/derived/post_activity_history.sql)
+    asof left join post_activity_history as post_activity
+        on
+            post_labels.post_id = post_activity.PostId
+            and post_labels.timestamp > post_activity.CreationDate
 ),
 
 last_question_feats as (
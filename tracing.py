@@ -0,0 +1,118 @@
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# finished spans, in the order they ended
+SPANS = []
+_LOCAL = threading.local()
+_LOCK = threading.Lock()
+_IDS = iter(range(1, sys.maxsize))
+_ORIGIN = time.perf_counter()
+
+
+def _peak_rss_mb() -> float:
+    """ Peak resident set size of the process so far (ru_maxrss is in bytes on macOS). """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def _stack() -> list:
+    if not hasattr(_LOCAL, 'stack'):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    """ Times the enclosed block as a span nested in the span currently open on this thread.
+
+    Records wall time, process CPU time (all threads), the process' peak RSS at the end of the span
+    and how much the span raised it, plus attrs (eg: split='val'). Yields the attrs dict so values
+    only known inside the block (eg: rows) can be added to it.
+    """
+    stack = _stack()
+    with _LOCK:
+        span_id = next(_IDS)
+    record = {
+        'id': span_id,
+        'parent_id': stack[-1] if stack else None,
+        'depth': len(stack),
+        'name': name,
+        'thread': threading.get_ident(),
+    }
+    stack.append(span_id)
+    start_peak_rss = _peak_rss_mb()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        end = time.perf_counter()
+        stack.pop()
+        peak_rss = _peak_rss_mb()
+        record.update(
+            start_s=start - _ORIGIN,
+            wall_s=end - start,
+            cpu_s=time.process_time() - start_cpu,
+            peak_rss_mb=peak_rss,
+            peak_rss_growth_mb=peak_rss - start_peak_rss,
+            attrs=attrs,
+        )
+        with _LOCK:
+            SPANS.append(record)
+
+
+def traced(name: str):
+    """ Decorator that runs every call of the decorated function in a span. """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_trace(path: str):
+    """ Writes the finished spans to path, as a Chrome trace (viewable in chrome://tracing or
+    Perfetto) if path ends with .json, and as JSON lines (one span per line) otherwise. """
+    spans = sorted(SPANS, key=lambda s: s['start_s'])
+    with open(path, 'w') as f:
+        if path.endswith('.json'):
+            events = [
+                {
+                    'name': s['name'],
+                    'ph': 'X',
+                    'ts': s['start_s'] * 1e6,
+                    'dur': s['wall_s'] * 1e6,
+                    'pid': os.getpid(),
+                    'tid': s['thread'],
+                    'args': {
+                        **s['attrs'],
+                        'cpu_s': s['cpu_s'],
+                        'peak_rss_mb': s['peak_rss_mb'],
+                        'peak_rss_growth_mb': s['peak_rss_growth_mb'],
+                    },
+                } for s in spans
+            ]
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+        else:
+            for s in spans:
+                f.write(json.dumps(s, default=str) + '\n')
+
+
+def summary() -> str:
+    """ Indented per-span table of the finished spans, in start order. """
+    lines = [f'{"span":<40}{"wall (s)":>10}{"cpu (s)":>10}{"peak rss (MB)":>15}  attrs']
+    for s in sorted(SPANS, key=lambda s: s['start_s']):
+        attrs = ' '.join(f'{k}={v}' for k, v in s['attrs'].items())
+        lines.append(
+            f'{"  " * s["depth"] + s["name"]:<40}{s["wall_s"]:>10.2f}{s["cpu_s"]:>10.2f}'
+            f'{s["peak_rss_mb"]:>15,.0f}  {attrs}'
+        )
+    return '\n'.join(lines)
@@ -1,16 +1,22 @@
 import argparse
+import functools
 import os
 import numpy as np
+import pandas as pd
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import duckdb
 from relbench.tasks import get_task
 from torch_frame import TaskType, stype
 from torch_frame.gbdt import LightGBM, XGBoost
 from torch_frame.data import Dataset
 from torch_frame.typing import Metric
 
+from boosters import TemporalCVLightGBM, WarmStartLightGBM
+import feature_store
 from inferred_stypes import task_to_stypes
+import sharding
+import tracing
 import utils
 
 SEED = 42
@@ -159,6 +165,80 @@ def map_preds(feats_df, labels, identifier_cols, preds):
     return new_preds
 
 
+def resolve_stypes(conn, full_task_name, infer=False, drop_cols=()):
+    """ Returns the col_to_stype dict for a task, validated against its train feature table, and
+    the columns of the table that have no stype (which should be dropped).
+
+    If infer is set, stypes are inferred from the table (and cached) with the entries of
+    inferred_stypes.task_to_stypes that still exist in the table taking precedence.
+    """
+    task_params = TASK_PARAMS[full_task_name]
+    table_name = f'{task_params["table_prefix"]}_train_feats'
+    if infer:
+        is_classification = task_params['task_type'] == TaskType.BINARY_CLASSIFICATION
+        overrides = {
+            **task_to_stypes.get(full_task_name, {}),
+            task_params['target_col']: stype.categorical if is_classification else stype.numerical,
+        }
+        col_to_stype = utils.infer_stypes(
+            conn, table_name, overrides=overrides,
+            cache_dir=os.path.join(task_params['dir'], '.stype_cache'),
+        )
+    else:
+        col_to_stype = dict(task_to_stypes[full_task_name])
+    untyped = utils.validate_stypes(conn, table_name, col_to_stype, ignore_cols=drop_cols)
+    return col_to_stype, untyped
+
+
+def feature_names(tf):
+    """ Column names in the order the boosters see them (categorical first, then numerical). """
+    return tf.col_names_dict.get(stype.categorical, []) + tf.col_names_dict.get(stype.numerical, [])
+
+
+def _shap_chunk(gbdt, tf):
+    """ TreeSHAP contributions for a single chunk of rows (last column is the bias term). """
+    if isinstance(gbdt, LightGBM):
+        x, _, _ = gbdt._to_lightgbm_input(tf)
+        # each chunk runs on its own pool thread, so keep lightgbm single threaded
+        return gbdt.model.predict(x, pred_contrib=True, num_threads=1)
+    import xgboost
+    x, _, feat_types = gbdt._to_xgboost_input(tf)
+    dmat = xgboost.DMatrix(x, feature_types=feat_types, enable_categorical=True, nthread=1)
+    return gbdt.model.predict(dmat, pred_contribs=True)
+
+
+def feature_importance_df(gbdt, tf, num_threads=None, chunk_size=50_000):
+    """ Per-feature gain/split importance and TreeSHAP summaries of a fitted booster on tf.
+
+    SHAP contributions are computed with the booster's native pred_contrib over row chunks scored
+    concurrently in a thread pool (both lightgbm and xgboost release the GIL while predicting).
+    """
+    names = feature_names(tf)
+    num_threads = num_threads or os.cpu_count()
+    chunks = [tf[i:i + chunk_size] for i in range(0, tf.num_rows, chunk_size)]
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        contribs = np.concatenate(list(pool.map(lambda c: _shap_chunk(gbdt, c), chunks)))
+    contribs = contribs[:, :len(names)]  # drop bias column
+    if isinstance(gbdt, LightGBM):
+        gain = gbdt.model.feature_importance(importance_type='gain')
+        split = gbdt.model.feature_importance(importance_type='split')
+    else:
+        gain_dict = gbdt.model.get_score(importance_type='total_gain')
+        split_dict = gbdt.model.get_score(importance_type='weight')
+        gain = np.array([gain_dict.get(f'f{i}', 0.0) for i in range(len(names))])
+        split = np.array([split_dict.get(f'f{i}', 0) for i in range(len(names))])
+    mean_abs_shap = np.abs(contribs).mean(axis=0)
+    return pd.DataFrame({
+        'feature': names,
+        'gain': gain.astype(float),
+        'gain_pct': gain / max(gain.sum(), 1e-12),
+        'split': split.astype(int),
+        'mean_abs_shap': mean_abs_shap,
+        'mean_shap': contribs.mean(axis=0),
+        'shap_pct': mean_abs_shap / max(mean_abs_shap.sum(), 1e-12),
+    }).sort_values('mean_abs_shap', ascending=False, ignore_index=True)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Argument Parser')
     parser.add_argument('--dataset', '-d', type=str, help='Relbench dataset name')
@@ -173,35 +253,230 @@ if __name__ == '__main__':
     parser.add_argument('--generate_feats', action='store_true',
                         help='Whether to (re)generate features specified in feats.sql')
     parser.add_argument('--drop_cols', nargs='+', default=[], help='Columns to drop')
+    parser.add_argument('--prune', action='store_true',
+                        help=(
+                            'If generate_feats is set, prune feats.sql so that columns in '
+                            'drop_cols (and the CTEs only they depend on) are never computed.'
+                        ))
+    parser.add_argument('--warm_start', action='store_true',
+                        help=(
+                            'LightGBM only. Build (and cache) the binned datasets once for all '
+                            'trials, early stop every trial and keep the best trial\'s model '
+                            'instead of retraining it.'
+                        ))
+    parser.add_argument('--refit', action='store_true',
+                        help=(
+                            'With --warm_start, refit the best config on train + val. Note that '
+                            'val metrics are no longer held out in that case.'
+                        ))
+    parser.add_argument('--cv_folds', type=int, default=0,
+                        help=(
+                            'LightGBM only. Score tuning trials by their mean score over this '
+                            'many rolling temporal folds of the train features (cut by label '
+                            'timestamp) instead of on val, training the folds of a trial in '
+                            'parallel. Implies --warm_start. Val is only used to early stop the '
+                            'final model.'
+                        ))
+    parser.add_argument('--infer_stypes', action='store_true',
+                        help=(
+                            'Infer stypes from the train feature table (cached per table schema) '
+                            'instead of relying only on inferred_stypes.py, whose entries still '
+                            'take precedence for existing columns.'
+                        ))
+    parser.add_argument('--compact_dtypes', action='store_true',
+                        help=(
+                            'Read feature tables with float32 numericals, uint8 booleans and '
+                            'ENUM-encoded categoricals to roughly halve their memory footprint.'
+                        ))
+    parser.add_argument('--feature_store', action='store_true',
+                        help=(
+                            'Store generated features as immutable, versioned Parquet files under '
+                            '<task dir>/feature_store (reusing versions generated from the same '
+                            'query over the same data) and read feature tables from their current '
+                            'versions.'
+                        ))
+    parser.add_argument('--writer', action='store_true',
+                        help=(
+                            'Don\'t open the database read-write. Read from the latest snapshot '
+                            'published by the writer process (see utils.serve_writer) and submit '
+                            'writes to it, so other jobs can use the database meanwhile.'
+                        ))
+    parser.add_argument('--read_only', action='store_true',
+                        help=(
+                            'Attach the database read-only (so other read-only jobs can use it '
+                            'meanwhile). Requires the feature tables to exist already, or '
+                            '--feature_store.'
+                        ))
+    parser.add_argument('--shards', type=int, default=1,
+                        help=(
+                            'If generate_feats is set, generate each split in this many worker '
+                            'processes, each on a hash partition of the label entities, to cut '
+                            'peak memory per process. Workers read a snapshot of the database, '
+                            'which is published first unless --read_only or --writer is set.'
+                        ))
+    parser.add_argument('--offline_eval', action='store_true',
+                        help=(
+                            'Evaluate against the val labels and test targets already in the '
+                            'database (<task>_val and <task>_test_labels, see '
+                            'utils.create_test_label_tables) instead of loading the relbench task.'
+                        ))
+    parser.add_argument('--importance', action='store_true',
+                        help=(
+                            'Whether to compute gain/split importance and val set SHAP values '
+                            'after tuning and write them to <table_prefix>_feature_importance.'
+                        ))
+    parser.add_argument('--trace', type=str, default=None,
+                        help=(
+                            'If provided, write per-stage timing spans (wall/CPU time, peak RSS, '
+                            'rows) to this path, as a Chrome trace if it ends with .json and as '
+                            'JSON lines otherwise.'
+                        ))
     args = parser.parse_args()
+    if args.read_only and args.importance:
+        parser.error('--importance writes to the database, so it can\'t be used with --read_only.')
+    if args.read_only and args.generate_feats and not args.feature_store:
+        parser.error('--generate_feats needs --feature_store when used with --read_only.')
     full_task_name = f'{args.dataset}-{args.task}'
     task_params = TASK_PARAMS[full_task_name]
-    conn = duckdb.connect(DATASET_TO_DB[args.dataset])
+    db_filename = DATASET_TO_DB[args.dataset]
+    if args.writer:
+        conn = utils.read_connection(db_filename)
+    elif args.read_only:
+        conn = utils.read_connection(db_filename, snapshot=False)
+    else:
+        conn = utils.get_connection(db_filename)
+    feat_tables = [f'{task_params["table_prefix"]}_{s}_feats' for s in ['train', 'val', 'test']]
+    store_dir = os.path.join(task_params['dir'], 'feature_store')
     if args.generate_feats:
         print('Generating features.')
         start = time.time()
         with open(os.path.join(task_params['dir'], 'feats.sql')) as f:
             template = f.read()
+        subsample = args.subsample
+        if args.shards > 1:
+            # shard workers attach the database read-only, so they can't use a file that this
+            # process holds read-write
+            if args.read_only:
+                shard_db = db_filename
+            elif not args.writer:
+                shard_db = utils.publish_snapshot(conn, db_filename)
+            subsample = sharding.shard_subsample(args.subsample, args.shards)
         # create train, val and test features
-        for s in ['train', 'val', 'test']:
+        for s, table_name in zip(['train', 'val', 'test'], feat_tables):
             print(f'Creating {s} table')
-            query = utils.render_jinja_sql(template, dict(set=s, subsample=args.subsample))
-            conn.sql(query)
-            print(f'{s} table created')
+            with tracing.span('generate_split', split=s) as span:
+                with tracing.span('render'):
+                    query = utils.render_jinja_sql(template, dict(set=s, subsample=subsample))
+                if args.prune:
+                    with tracing.span('prune'):
+                        keep_cols = [
+                            c for c in task_to_stypes[full_task_name] if c not in args.drop_cols
+                        ]
+                        query = utils.prune_query(query, keep_cols, conn=conn)
+                write_fn = None
+                if args.shards > 1:
+                    if args.writer:
+                        shard_db = utils.latest_snapshot(db_filename) or db_filename
+                    write_fn = functools.partial(
+                        sharding.write_sharded, conn, shard_db, query,
+                        f'{task_params["table_prefix"]}_{s}', task_params['identifier_cols'][0],
+                        args.shards,
+                    )
+                with tracing.span('sql', shards=args.shards) as sql_span:
+                    if args.feature_store:
+                        # a subsampled train split is random, so it is never reused
+                        version = None
+                        data_hash = feature_store.data_fingerprint(conn, query)
+                        if s != 'train' or args.subsample == 0:
+                            version = feature_store.find_version(
+                                store_dir, table_name, feature_store.sql_hash(query),
+                                args.subsample, data_hash=data_hash,
+                            )
+                        if version is not None:
+                            feature_store.set_current(store_dir, table_name, version)
+                            print(f'{s} table reused from version {version} (same query and data)')
+                        else:
+                            meta = feature_store.write_version(
+                                conn, query, store_dir, table_name, subsample=args.subsample,
+                                write_fn=write_fn, data_hash=data_hash,
+                            )
+                            print(f'{s} table stored as version {meta["version"]}')
+                        sql_span['reused'] = version is not None
+                        feature_store.register_views(conn, store_dir, [table_name])
+                    elif write_fn is not None:
+                        path = os.path.join(task_params['dir'], f'.{table_name}.parquet')
+                        write_fn(path)
+                        query = (
+                            f'create or replace table {table_name} as '
+                            f"select * from read_parquet('{os.path.abspath(path)}')"
+                        )
+                        if args.writer:
+                            utils.submit_writes(db_filename, [query])
+                            conn.close()
+                            conn = utils.read_connection(db_filename)
+                        else:
+                            conn.sql(query)
+                        os.remove(path)
+                        print(f'{s} table created')
+                    elif args.writer:
+                        utils.submit_writes(db_filename, [query])
+                        # reattach to see the new table
+                        conn.close()
+                        conn = utils.read_connection(db_filename)
+                        print(f'{s} table created')
+                    else:
+                        conn.sql(query)
+                        print(f'{s} table created')
+                    sql_span['rows'] = conn.sql(f'select count(*) from {table_name}').fetchone()[0]
+                if s == 'train':
+                    # fail before generating the remaining splits if the stypes are out of date
+                    with tracing.span('resolve_stypes'):
+                        col_to_stype, untyped = resolve_stypes(
+                            conn, full_task_name, infer=args.infer_stypes, drop_cols=args.drop_cols
+                        )
+                        args.drop_cols += untyped
+                span['rows'] = sql_span['rows']
         print(f'Features generated in {time.time() - start:,.0f} seconds.')
+    else:
+        if args.feature_store:
+            feature_store.register_views(conn, store_dir, feat_tables)
+        with tracing.span('resolve_stypes'):
+            col_to_stype, untyped = resolve_stypes(
+                conn, full_task_name, infer=args.infer_stypes, drop_cols=args.drop_cols
+            )
+            args.drop_cols += untyped
 
-    train_df = conn.sql(f'select * from {task_params["table_prefix"]}_train_feats').df()
-    val_df = conn.sql(f'select * from {task_params["table_prefix"]}_val_feats').df()
-    test_df = conn.sql(f'select * from {task_params["table_prefix"]}_test_feats').df()
+    with tracing.span('fetch', compact=args.compact_dtypes) as span:
+        start = time.time()
+        keep_dtype_cols = task_params['identifier_cols'] + [task_params['target_col']]
+        dfs = []
+        for t in feat_tables:
+            with tracing.span('fetch_table', table=t) as table_span:
+                if args.compact_dtypes:
+                    dfs.append(utils.fetch_compact_df(
+                        conn, t, col_to_stype,
+                        keep_dtype_cols=keep_dtype_cols,
+                        enum_tables=feat_tables,
+                        exclude_cols=args.drop_cols,
+                        enum_prefix=task_params['table_prefix'],
+                    ))
+                else:
+                    dfs.append(conn.sql(f'select * from {t}').df())
+                table_span['rows'] = len(dfs[-1])
+        train_df, val_df, test_df = dfs
+        span['rows'] = sum(len(df) for df in dfs)
+        if args.compact_dtypes:
+            print(f'Fetched compact feature tables in {time.time() - start:,.0f} seconds.')
     conn.close()
-    col_to_stype = task_to_stypes[full_task_name]
     drop_cols = task_params['identifier_cols'] + args.drop_cols
-    train_df = train_df.drop(args.drop_cols, axis=1)
-    val_df = val_df.drop(args.drop_cols, axis=1)
-    for col in args.drop_cols:
-        del col_to_stype[col]
-    if args.subsample > 0 and not args.generate_feats:
-        train_df = train_df.sample(args.subsample, replace=False, random_state=SEED)
+    with tracing.span('drop_columns', cols=len(args.drop_cols)):
+        # pruned feature tables won't contain the dropped columns in the first place
+        train_df = train_df.drop(args.drop_cols, axis=1, errors='ignore')
+        val_df = val_df.drop(args.drop_cols, axis=1, errors='ignore')
+        for col in args.drop_cols:
+            col_to_stype.pop(col, None)
+        if args.subsample > 0 and not args.generate_feats:
+            train_df = train_df.sample(args.subsample, replace=False, random_state=SEED)
     print('Materializing torch-frame dataset.')
     start = time.time()
     # TODO add support for text embeddings
@@ -211,41 +486,130 @@ if __name__ == '__main__':
                 'Embeddings for text columns not supported for speed considerations. Either drop'
                 'them with the --drop_cols flag or see relbench/examples for how to use embeddings.'
             )
-    train_dset = Dataset(
-        train_df,
-        col_to_stype=col_to_stype,
-        target_col=task_params['target_col'],
-    ).materialize()
-    val_tf = train_dset.convert_to_tensor_frame(val_df)
+    with tracing.span('materialize', rows=len(train_df)):
+        train_dset = Dataset(
+            train_df,
+            col_to_stype=col_to_stype,
+            target_col=task_params['target_col'],
+        ).materialize()
+    with tracing.span('convert', split='val', rows=len(val_df)):
+        val_tf = train_dset.convert_to_tensor_frame(val_df)
     print(f'Materialized torch-frame dataset in {time.time() - start:,.0f} seconds.')
     print(
         f'Train Size: {train_dset.tensor_frame.num_rows:,} x {train_dset.tensor_frame.num_cols:,}'
     )
 
     booster = LightGBM if args.booster == 'lgbm' else XGBoost
+    booster_kwargs = {}
+    if args.warm_start or args.cv_folds > 0:
+        if args.booster != 'lgbm':
+            raise NotImplementedError(
+                '--warm_start and --cv_folds are only supported for LightGBM.'
+            )
+        booster = WarmStartLightGBM
+        booster_kwargs = dict(
+            cache_dir=os.path.join(task_params['dir'], '.lgbm_cache'), refit=args.refit
+        )
+        if args.cv_folds > 0:
+            # the rows of the train TensorFrame are those of train_df, in the same order
+            booster = TemporalCVLightGBM
+            booster_kwargs.update(
+                timestamps=train_df[task_params['identifier_cols'][-1]].to_numpy(),
+                num_folds=args.cv_folds,
+            )
     if task_params['task_type'] == TaskType.BINARY_CLASSIFICATION:
-        gbdt = booster(task_params['task_type'], num_classes=2, metric=task_params['tune_metric'])
+        gbdt = booster(
+            task_params['task_type'], num_classes=2, metric=task_params['tune_metric'],
+            **booster_kwargs
+        )
     elif task_params['task_type'] == TaskType.REGRESSION:
-        gbdt = booster(task_params['task_type'], metric=task_params['tune_metric'])
+        gbdt = booster(
+            task_params['task_type'], metric=task_params['tune_metric'], **booster_kwargs
+        )
+    if booster in (LightGBM, XGBoost):
+        # torch_frame's boosters run every optuna trial through their objective method
+        gbdt.objective = tracing.traced('tune_trial')(gbdt.objective)
     print('Starting hparam tuning.')
     start = time.time()
-    gbdt.tune(tf_train=train_dset.tensor_frame, tf_val=val_tf, num_trials=NUM_TRIALS)
+    with tracing.span('tune', rows=train_dset.tensor_frame.num_rows, trials=NUM_TRIALS):
+        gbdt.tune(tf_train=train_dset.tensor_frame, tf_val=val_tf, num_trials=NUM_TRIALS)
     print(f'Hparam tuning completed in {time.time() - start:,.0f} seconds.')
     model_path = os.path.join(task_params['dir'], f'{full_task_name}_{args.booster}.json')
     print(f'Saving model to "{model_path}".')
     gbdt.save(model_path)
     print()
 
+    if args.importance:
+        print('Computing feature importance.')
+        start = time.time()
+        with tracing.span('importance', rows=val_tf.num_rows):
+            importance_df = feature_importance_df(gbdt, val_tf)
+            importance_table = f'{task_params["table_prefix"]}_feature_importance'
+            query = f'create or replace table {importance_table} as select * from importance_df'
+            if args.writer:
+                utils.submit_writes(db_filename, [query], dfs={'importance_df': importance_df})
+            else:
+                conn = utils.get_connection(db_filename)
+                conn.sql(query)
+                conn.close()
+        print(f'Feature importance computed in {time.time() - start:,.0f} seconds.')
+        print(importance_df.head(20).to_string(index=False))
+        print()
+
     print('Evaluating model.')
-    task = get_task(args.dataset, args.task, download=True)
+    if args.offline_eval:
+        if args.writer:
+            conn = utils.read_connection(db_filename)
+        elif args.read_only:
+            conn = utils.read_connection(db_filename, snapshot=False)
+        else:
+            conn = utils.get_connection(db_filename)
+        is_classification = task_params['task_type'] == TaskType.BINARY_CLASSIFICATION
+    else:
+        with tracing.span('load_task'):
+            task = get_task(args.dataset, args.task, download=True)
     print()
-    pred = gbdt.predict(tf_test=val_tf).numpy()
-    assert len(task.get_table("val").df) == len(val_df), 'Val: feats df doesn\'t match label df!'
-    pred = map_preds(val_df, task.get_table("val").df, task_params['identifier_cols'], pred)
-    print(f'Val: {task.evaluate(pred, task.get_table("val"))}')
+    with tracing.span('predict', split='val', rows=val_tf.num_rows):
+        pred = gbdt.predict(tf_test=val_tf).numpy()
+    if args.offline_eval:
+        with tracing.span('evaluate', split='val'):
+            val_metrics = utils.evaluate_preds(
+                conn, f'{task_params["table_prefix"]}_val', val_df, pred,
+                task_params['identifier_cols'], task_params['target_col'],
+                classification=is_classification,
+            )
+            print(f'Val: {val_metrics}')
+    else:
+        labels = task.get_table("val").df
+        assert len(labels) == len(val_df), 'Val: feats df doesn\'t match label df!'
+        with tracing.span('map_preds', split='val', rows=len(val_df)):
+            pred = map_preds(val_df, labels, task_params['identifier_cols'], pred)
+        with tracing.span('evaluate', split='val'):
+            print(f'Val: {task.evaluate(pred, task.get_table("val"))}')
     print()
-    test_tf = train_dset.convert_to_tensor_frame(test_df)
-    assert len(task.get_table("test").df) == len(test_df), 'Test: feats df doesn\'t match label df!'
-    pred = gbdt.predict(tf_test=test_tf).numpy()
-    pred = map_preds(test_df, task.get_table("test").df, task_params['identifier_cols'], pred)
-    print(f'Test: {task.evaluate(pred)}')
+    with tracing.span('convert', split='test', rows=len(test_df)):
+        test_tf = train_dset.convert_to_tensor_frame(test_df)
+    with tracing.span('predict', split='test', rows=test_tf.num_rows):
+        pred = gbdt.predict(tf_test=test_tf).numpy()
+    if args.offline_eval:
+        with tracing.span('evaluate', split='test'):
+            test_metrics = utils.evaluate_preds(
+                conn, f'{task_params["table_prefix"]}_test_labels', test_df, pred,
+                task_params['identifier_cols'], task_params['target_col'],
+                classification=is_classification,
+            )
+            print(f'Test: {test_metrics}')
+        conn.close()
+    else:
+        labels = task.get_table("test").df
+        assert len(labels) == len(test_df), 'Test: feats df doesn\'t match label df!'
+        with tracing.span('map_preds', split='test', rows=len(test_df)):
+            pred = map_preds(test_df, labels, task_params['identifier_cols'], pred)
+        with tracing.span('evaluate', split='test'):
+            print(f'Test: {task.evaluate(pred)}')
+
+    if args.trace is not None:
+        print()
+        print(tracing.summary())
+        tracing.write_trace(args.trace)
+        print(f'Trace written to "{args.trace}".')
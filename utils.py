@@ -1,24 +1,44 @@
+import functools
+import hashlib
+import json
+from multiprocessing.connection import Client, Listener
+import os
+import queue
+import shutil
+import threading
+import time
+
 import duckdb
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 import pandas as pd
+import sqlglot
+from sqlglot import exp
 from relbench.datasets import get_dataset
 from relbench.tasks import get_task
+from sklearn import metrics
 from sklearn.feature_selection import mutual_info_classif, mutual_info_regression
+from torch_frame import stype
 
 DATASET_INFO = {
     'rel-stack': {
         'tables': ['users', 'posts', 'votes', 'badges', 'comments', 'postHistory'],
-        'tasks': ['user-engagement', 'user-badge', 'post-votes']
+        'tasks': ['user-engagement', 'user-badge', 'post-votes'],
+        'dir': 'stack',
+        'derived_tables': ['text_stats', 'post_activity_history'],
     },
 
     'rel-amazon': {
         'tables': ['review', 'customer', 'product'],
-        'tasks': ['user-churn', 'user-ltv', 'product-ltv', 'product-churn']
+        'tasks': ['user-churn', 'user-ltv', 'item-ltv', 'item-churn'],
+        'dir': 'amazon',
+        'derived_tables': ['customer_review_history', 'product_rating_stats'],
     },
 
     'rel-hm': {
         'tables': ['article', 'customer', 'transactions'],
         'tasks': ['user-churn', 'item-sales'],
+        'dir': 'hm',
+        'derived_tables': ['customer_txn_history', 'article_txn_history'],
     },
 
     'rel-f1': {
@@ -65,11 +85,788 @@ def db_setup(dataset_name: str, db_filename: str):
         conn.sql(f'create table {task_name}_train as select * from train_table')
         conn.sql(f'create table {task_name}_val as select * from val_table')
         conn.sql(f'create table {task_name}_test as select * from test_table')
+    create_test_label_tables(dataset_name, conn)
+    prepare_label_tables(dataset_name, conn)
+    create_derived_tables(dataset_name, conn)
     conn.close()
 
 
-def render_jinja_sql(query: str, context: dict) -> str:
-    return Template(query).render(context)
+def create_test_label_tables(dataset_name: str, conn: duckdb.DuckDBPyConnection):
+    """ (Re)builds the <task>_test_labels tables, which hold the test targets that relbench masks
+    out of <task>_test, so test predictions can be evaluated offline (see evaluate_preds).
+
+    Feature queries must never read these. db_setup builds them, but this can be called to add them
+    to an existing database (it reads the tasks from the relbench cache).
+
+    Args:
+        dataset_name (str): The name of the relbench dataset.
+        conn (duckdb.DuckDBPyConnection): Connection to the dataset's DuckDB database.
+    """
+    for task_name in DATASET_INFO[dataset_name]['tasks']:
+        task = get_task(dataset_name, task_name, download=True)
+        test_table = task.get_table('test', mask_input_cols=False).df  # noqa
+        task_name = task_name.replace('-', '_')
+        conn.sql(f'create or replace table {task_name}_test_labels as select * from test_table')
+
+
+def prepare_label_tables(dataset_name: str, conn: duckdb.DuckDBPyConnection):
+    """ Sorts the <task>_<split> label tables by (timestamp, entity), builds their
+    <task>_<split>_timestamps tables and refreshes the statistics of both.
+
+    Feature queries join the labels on (entity, timestamp) and filter the other tables by timestamp,
+    so sorted label tables let DuckDB skip row groups by their min/max timestamp. The timestamps
+    tables hold one row per distinct label timestamp with its number of label rows, distinct
+    entities and the offset of its first row in the sorted table, so that the distinct timestamps
+    (eg: for product_rating_stats) and per-timestamp sizes are read without scanning the labels.
+    db_setup calls this, but it can be called on an existing database (it reads the entity and time
+    columns of the tasks from the relbench cache).
+
+    Args:
+        dataset_name (str): The name of the relbench dataset.
+        conn (duckdb.DuckDBPyConnection): Connection to the dataset's DuckDB database.
+    """
+    for task_name in DATASET_INFO[dataset_name]['tasks']:
+        task = get_task(dataset_name, task_name, download=True)
+        time_col = task.time_col
+        entity_col = getattr(task, 'entity_col', None) or task.src_entity_col
+        task_name = task_name.replace('-', '_')
+        for split in ['train', 'val', 'test']:
+            table_name = f'{task_name}_{split}'
+            # a failure midway (eg: out of memory while sorting) must not lose the label table
+            conn.sql('begin')
+            try:
+                conn.sql(f"""
+                    create or replace table _{table_name}_sorted as
+                    select * from {table_name} order by "{time_col}", "{entity_col}"
+                """)
+                conn.sql(f'drop table {table_name}')
+                conn.sql(f'alter table _{table_name}_sorted rename to {table_name}')
+                conn.sql(f"""
+                    create or replace table {table_name}_timestamps as
+                    select
+                        "{time_col}",
+                        count(*) as num_rows,
+                        count(distinct "{entity_col}") as num_entities,
+                        sum(count(*)) over (order by "{time_col}") - count(*) as row_offset
+                    from {table_name}
+                    group by "{time_col}"
+                    order by "{time_col}"
+                """)
+                conn.sql('commit')
+            except Exception:
+                conn.sql('rollback')
+                raise
+            conn.sql(f'analyze {table_name}')
+            conn.sql(f'analyze {table_name}_timestamps')
+
+
+def create_derived_tables(
+    dataset_name: str, conn: duckdb.DuckDBPyConnection, since: str = None
+):
+    """ (Re)builds the dataset-level tables (or columns of the raw tables) precomputed from the raw
+    tables.
+
+    These are defined in <dataset dir>/derived/<name>.sql and are shared by the feats.sql of
+    several tasks. db_setup builds them, but this can be called to refresh an existing database.
+    The files are Jinja templates rendered with `since`: after appending rows from a date on to the
+    raw tables, pass that date so that templates that support it (eg: hm/derived/*.sql) only
+    recompute what changed. The others are rebuilt in full regardless.
+
+    Args:
+        dataset_name (str): The name of the relbench dataset.
+        conn (duckdb.DuckDBPyConnection): Connection to the dataset's DuckDB database.
+        since (str): First date of the rows appended since the last refresh (eg: '2020-09-22').
+    """
+    info = DATASET_INFO[dataset_name]
+    for table_name in info.get('derived_tables', []):
+        with open(os.path.join(info['dir'], 'derived', f'{table_name}.sql')) as f:
+            conn.sql(render_jinja_sql(f.read(), dict(since=since)))
+
+
+# DuckDB lets a single process open a database file read-write, and no other process can open it
+# (even read-only) meanwhile. So that several notebooks and training jobs can use a dataset at once:
+#   - get_connection reuses a single database instance per file within a process,
+#   - one writer process (serve_writer) runs the write jobs that other processes submit to it over
+#     a local socket (submit_writes), and publishes a snapshot of the database when jobs ask,
+#   - readers attach the latest snapshot read-only (read_connection) and never take the write lock.
+_CONNECTIONS = {}
+SNAPSHOTS_TO_KEEP = 2
+
+
+def get_connection(db_filename: str, read_only: bool = False) -> duckdb.DuckDBPyConnection:
+    """ Returns a cursor on a database instance shared by the whole process.
+
+    Closing the cursor doesn't close the shared instance, so callers can open and close
+    connections freely. A read-only request reuses an existing read-write instance.
+    """
+    path = os.path.abspath(db_filename)
+    key = (os.getpid(), path)  # forked processes can't share the parent's instance
+    if key not in _CONNECTIONS:
+        _CONNECTIONS[key] = (duckdb.connect(path, read_only=read_only), read_only)
+    conn, conn_read_only = _CONNECTIONS[key]
+    if conn_read_only and not read_only:
+        raise ValueError(
+            f'{path} is already open read-only in this process. Submit writes to the writer '
+            'process with submit_writes instead.'
+        )
+    return conn.cursor()
+
+
+def _snapshot_dir(db_filename: str) -> str:
+    path = os.path.abspath(db_filename)
+    return os.path.join(os.path.dirname(path), '.snapshots', os.path.basename(path))
+
+
+def _writer_address(db_filename: str) -> str:
+    return f'{os.path.abspath(db_filename)}.writer.sock'
+
+
+def latest_snapshot(db_filename: str) -> str:
+    """ Path of the latest published snapshot of a database, or None if there is none. """
+    snapshot_dir = _snapshot_dir(db_filename)
+    if not os.path.isdir(snapshot_dir):
+        return None
+    snapshots = sorted(f for f in os.listdir(snapshot_dir) if f.endswith('.db'))
+    return os.path.join(snapshot_dir, snapshots[-1]) if snapshots else None
+
+
+def publish_snapshot(conn: duckdb.DuckDBPyConnection, db_filename: str) -> str:
+    """ Checkpoints the database and copies it to a new snapshot, returning its path.
+
+    Must be called by the process holding the write lock, between writes. Only the latest
+    SNAPSHOTS_TO_KEEP snapshots are kept (readers that attached an older one keep their open file).
+    """
+    conn.sql('checkpoint')
+    snapshot_dir = _snapshot_dir(db_filename)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    name = f'{time.time_ns()}.db'
+    tmp_path = os.path.join(snapshot_dir, f'.{name}.tmp')
+    shutil.copyfile(os.path.abspath(db_filename), tmp_path)
+    os.rename(tmp_path, os.path.join(snapshot_dir, name))
+    snapshots = sorted(f for f in os.listdir(snapshot_dir) if f.endswith('.db'))
+    for old in snapshots[:-SNAPSHOTS_TO_KEEP]:
+        os.remove(os.path.join(snapshot_dir, old))
+    return os.path.join(snapshot_dir, name)
+
+
+def db_alias(db_filename: str) -> str:
+    """ Name read_connection attaches a database under. Cursors of its connections start out in
+    the in-memory database, so they need a `use` of it before referencing tables. """
+    return os.path.splitext(os.path.basename(db_filename))[0]
+
+
+def read_connection(db_filename: str, snapshot: bool = True) -> duckdb.DuckDBPyConnection:
+    """ Returns an in-memory connection with the latest snapshot of a database attached read-only.
+
+    The snapshot is the default database, so tables are referenced as usual, while temp objects
+    live in memory. Attaches the database file itself if
+    snapshot is False or no snapshot was published yet, which fails if another process is writing
+    to it.
+    """
+    path = (snapshot and latest_snapshot(db_filename)) or os.path.abspath(db_filename)
+    alias = db_alias(db_filename)
+    conn = duckdb.connect()
+    conn.sql(f"attach '{path}' as {alias} (read_only)")
+    conn.sql(f'use {alias}')
+    return conn
+
+
+def _reply(client, message):
+    """ Sends a reply to a submit_writes client and closes it, logging clients that went away. """
+    try:
+        client.send(message)
+    except (OSError, EOFError) as e:
+        print(f'Dropped a writer client that went away: {type(e).__name__}: {e}')
+    finally:
+        client.close()
+
+
+def serve_writer(db_filename: str):
+    """ Runs the single writer process of a database. Blocks forever.
+
+    Write jobs submitted with submit_writes are queued and executed one at a time, in submission
+    order, on the only read-write connection to the database. Each job runs in a transaction, so a
+    failed job leaves the database as it was. A snapshot is published at startup, and once the
+    queue is empty after jobs that asked for one (so a burst of jobs is copied once, not per job).
+    """
+    conn = duckdb.connect(db_filename)
+    publish_snapshot(conn, db_filename)
+    address = _writer_address(db_filename)
+    if os.path.exists(address):
+        os.remove(address)
+    jobs = queue.Queue()
+
+    def accept(listener):
+        while True:
+            try:
+                client = listener.accept()
+            except Exception as e:
+                print(f'Failed to accept a writer client: {type(e).__name__}: {e}')
+                continue
+            try:
+                jobs.put((client, client.recv()))
+            except Exception as e:
+                # eg: the client disconnected, or sent something that doesn't unpickle
+                print(f'Dropped a writer client before its job: {type(e).__name__}: {e}')
+                client.close()
+
+    with Listener(address, family='AF_UNIX') as listener:
+        os.chmod(address, 0o660)
+        threading.Thread(target=accept, args=(listener,), daemon=True).start()
+        print(f'Writer for {db_filename} listening on {address}.')
+        # clients whose jobs are committed and which wait for the next snapshot
+        awaiting_snapshot = []
+        while True:
+            client, (queries, dfs, publish) = jobs.get()
+            start = time.time()
+            try:
+                conn.sql('begin')
+                for name, df in dfs.items():
+                    conn.register(name, df)
+                for query in queries:
+                    conn.sql(query)
+                conn.sql('commit')
+            except Exception as e:
+                conn.sql('rollback')
+                _reply(client, ('error', f'{type(e).__name__}: {e}'))
+            else:
+                print(f'Ran a job of {len(queries)} queries in {time.time() - start:,.1f} seconds.')
+                if publish:
+                    awaiting_snapshot.append(client)
+                else:
+                    _reply(client, ('ok', None))
+            finally:
+                for name in dfs:
+                    conn.unregister(name)
+            if awaiting_snapshot and jobs.empty():
+                try:
+                    reply = ('ok', publish_snapshot(conn, db_filename))
+                except Exception as e:
+                    reply = ('error', f'Publishing a snapshot failed: {type(e).__name__}: {e}')
+                for waiting in awaiting_snapshot:
+                    _reply(waiting, reply)
+                awaiting_snapshot = []
+
+
+def submit_writes(db_filename: str, queries: list, dfs: dict = None, publish: bool = True) -> str:
+    """ Runs queries in the writer process of a database and waits for them to complete.
+
+    dfs maps names to pandas DataFrames that the queries can select from (eg: to write a DataFrame
+    to a table). If publish is set, waits for a snapshot that includes the job and returns its path
+    (otherwise returns None, and readers see the writes from the next published snapshot). Raises a
+    RuntimeError if the job failed, in which case none of its queries were applied.
+    """
+    with Client(_writer_address(db_filename), family='AF_UNIX') as client:
+        client.send((list(queries), dict(dfs or {}), publish))
+        status, result = client.recv()
+    if status == 'error':
+        raise RuntimeError(f'Write job failed in the writer process of {db_filename}: {result}')
+    return result
+
+
+# templates can import the shared macros in macros.sql (or any other file in the repo). Templates
+# loaded by path (imported macros, render_jinja_file) are compiled once per process and their
+# bytecode is cached on disk under the path, and both are invalidated when the file's mtime changes
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+JINJA_CACHE_DIR = os.path.join(_REPO_DIR, '.jinja_cache')
+
+
+@functools.lru_cache(maxsize=None)
+def _jinja_env() -> Environment:
+    # built on first render, so importing utils doesn't create the cache directory
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    return Environment(
+        loader=FileSystemLoader(_REPO_DIR),
+        bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_DIR),
+        auto_reload=True,
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_template(query: str):
+    # notebooks and scripts render the same template text once per split (and subsample), so it
+    # is only compiled the first time
+    return _jinja_env().from_string(query)
+
+
+def render_jinja_sql(query: str, context: dict, approx: bool = False) -> str:
+    """ Renders a feats.sql template. With approx, exact aggregates are swapped for approximate ones
+    (see approximate_query), for faster exploratory runs. """
+    query = _compile_template(query).render(context)
+    return approximate_query(query) if approx else query
+
+
+def render_jinja_file(path: str, context: dict, approx: bool = False) -> str:
+    """ Same as render_jinja_sql, for a template file in the repo (eg: amazon/user-churn/feats.sql),
+    whose compiled bytecode is cached on disk across processes. """
+    name = os.path.relpath(os.path.abspath(path), _REPO_DIR).replace(os.sep, '/')
+    query = _jinja_env().get_template(name).render(context)
+    return approximate_query(query) if approx else query
+
+
+def to_duckdb_sql(tree: exp.Expression, **kwargs) -> str:
+    """ Generates DuckDB SQL from a sqlglot tree (kwargs go to Expression.sql), raising a ValueError
+    if DuckDB can't parse it. sqlglot doesn't round-trip every DuckDB construct (eg: it turns
+    `0.95**x` into invalid SQL), so rewritten queries are checked rather than run corrupted. """
+    query = tree.sql(dialect='duckdb', **kwargs)
+    try:
+        duckdb.extract_statements(query)
+    except duckdb.ParserException as e:
+        raise ValueError(f'sqlglot generated SQL that DuckDB can\'t parse ({e}):\n{query}') from e
+    return query
+
+
+# fraction of rows that approximate mode() aggregates are computed over
+APPROX_MODE_SAMPLE = 0.2
+
+
+def approximate_query(query: str, mode_sample: float = APPROX_MODE_SAMPLE) -> str:
+    """ Swaps the expensive exact aggregates of a rendered query for approximate ones.
+
+    count(distinct x) becomes approx_count_distinct(x) (HyperLogLog), median(x) and
+    quantile_cont(x, q) become approx_quantile(x, q) (t-digest) and mode(x) is computed over a
+    random mode_sample fraction of its rows, falling back to a random row's value for groups where
+    no row is drawn (so single-row groups stay exact). Window functions are left exact, and other
+    aggregates (eg: stddev or arg_max) are already computed in a single pass with constant state.
+    Use approx_error_report to measure the error.
+
+    Sampled modes are only reliable for large groups. On synthetic groups of 1-200 rows over 10
+    skewed values, the approximate value wasn't one of the exact modes for 26% of groups of 3-5
+    rows, 42% of 6-10, 30% of 11-50 and 4% of larger ones. Keeping mode exact below a group size
+    (`case when count(*) < k`) doesn't help, since duckdb then computes both modes for every group.
+    """
+    tree = sqlglot.parse_one(query, read='duckdb')
+    for node in list(tree.find_all(exp.Func)):
+        parent = node.parent.parent if isinstance(node.parent, exp.Filter) else node.parent
+        if isinstance(parent, exp.Window):
+            continue
+        # median and mode are only typed nodes in some sqlglot versions, so match on the name
+        name = node.name.upper() if isinstance(node, exp.Anonymous) else node.sql_name()
+        if isinstance(node, exp.Count):
+            distinct = node.this
+            if isinstance(distinct, exp.Distinct) and len(distinct.expressions) == 1:
+                node.replace(exp.ApproxDistinct(this=distinct.expressions[0]))
+        elif isinstance(node, exp.PercentileCont):
+            node.replace(exp.ApproxQuantile(this=node.this, quantile=node.expression))
+        elif name == 'MEDIAN':
+            this = node.expressions[0] if isinstance(node, exp.Anonymous) else node.this
+            node.replace(exp.ApproxQuantile(this=this, quantile=exp.Literal.number(0.5)))
+        elif name == 'MODE':
+            sampled = exp.LT(
+                this=exp.Anonymous(this='random'), expression=exp.Literal.number(mode_sample)
+            )
+            this = node.expressions[0] if isinstance(node, exp.Anonymous) else node.this
+            # a random row of the group, for groups where no row is drawn
+            fallback = exp.ArgMin(this=this.copy(), expression=exp.Anonymous(this='random'))
+            if isinstance(node.parent, exp.Filter):
+                filtered = node.parent
+                where = filtered.expression
+                fallback = exp.Filter(this=fallback, expression=where.copy())
+                where.set('this', exp.and_(where.this, sampled))
+            else:
+                filtered = exp.Filter(this=node.copy(), expression=exp.Where(this=sampled))
+                node.replace(filtered)
+            filtered.replace(exp.Coalesce(this=filtered.copy(), expressions=[fallback]))
+    return to_duckdb_sql(tree)
+
+
+def approx_error_report(
+    exact: pd.DataFrame,
+    approx: pd.DataFrame,
+    identifier_cols: list,
+) -> pd.DataFrame:
+    """ Compares the features of an approximate run of a feats.sql query (see approximate_query)
+    against an exact run on the same labels, one row per column that differs.
+
+    Rows are matched on identifier_cols. For each column, reports the fraction of rows whose value
+    differs (including rows that are null in only one run) and, for numeric columns, the mean and
+    max relative error over rows that are non-null in both runs.
+    """
+    merged = exact.merge(approx, on=identifier_cols, suffixes=('', '__approx'))
+    rows = {}
+    for col in exact.columns:
+        if col in identifier_cols:
+            continue
+        a, b = merged[col], merged[f'{col}__approx']
+        both = a.notna() & b.notna()
+        differs = a.notna() != b.notna()
+        if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+            a, b = a[both].astype(float), b[both].astype(float)
+            rel_error = (a - b).abs() / a.abs().clip(lower=1e-9)
+            rel_error[(a - b).abs() < 1e-9] = 0.0
+            differs[both] = rel_error > 0
+            rel_error = rel_error.agg(['mean', 'max']).values if len(rel_error) else [0.0, 0.0]
+        else:
+            differs[both] = a[both].astype(str) != b[both].astype(str)
+            rel_error = [float('nan'), float('nan')]
+        if differs.any():
+            rows[col] = [differs.mean(), *rel_error]
+    report = pd.DataFrame.from_dict(
+        rows, orient='index', columns=['mismatch_rate', 'mean_rel_error', 'max_rel_error']
+    )
+    report.attrs['num_rows'] = len(merged)
+    return report.sort_values('mismatch_rate', ascending=False)
+
+
+def copy_to_parquet(conn: duckdb.DuckDBPyConnection, query: str, path: str):
+    """ Runs a rendered feats.sql query and writes its result to a Parquet file instead of a table.
+
+    The `create or replace table ... as` of the query is turned into a `copy ... to`, so this
+    works on read-only connections.
+    """
+    tree = sqlglot.parse_one(query, read='duckdb')
+    select = tree.expression if isinstance(tree, exp.Create) else tree
+    conn.sql(f"copy ({to_duckdb_sql(select)}) to '{path}' (format parquet)")
+
+
+# duckdb aggregates that sqlglot parses as anonymous functions
+_ANONYMOUS_AGGS = {'MODE', 'ENTROPY', 'HISTOGRAM', 'RESERVOIR_QUANTILE', 'LIST', 'FAVG', 'FSUM'}
+
+
+def _is_aggregate(node: exp.Expression) -> bool:
+    return node.find(exp.AggFunc) is not None or any(
+        a.name.upper() in _ANONYMOUS_AGGS for a in node.find_all(exp.Anonymous)
+    )
+
+
+def _star(proj: exp.Expression):
+    if isinstance(proj, exp.Star):
+        return proj
+    if isinstance(proj, exp.Column) and isinstance(proj.this, exp.Star):
+        return proj.this
+    return None
+
+
+def _sources(select: exp.Select) -> dict:
+    """ Maps each alias in the FROM/JOIN clauses of select to the table (or CTE) it reads. """
+    tables = [select.args['from'].this] if select.args.get('from') else []
+    tables += [j.this for j in select.args.get('joins') or []]
+    return {t.alias_or_name: t.name for t in tables if isinstance(t, exp.Table)}
+
+
+def _columns(node: exp.Expression):
+    """ Column references in node, ignoring CTE definitions and star exclude lists. """
+    for col in node.find_all(exp.Column):
+        if not any(isinstance(p, (exp.With, exp.Star)) for p in _parents(col, node)):
+            yield col
+
+
+def _parents(node: exp.Expression, root: exp.Expression):
+    while node is not root and node.parent is not None:
+        node = node.parent
+        yield node
+
+
+def _output_names(name: str, ctes: dict, conn: duckdb.DuckDBPyConnection = None):
+    """ Output column names of a CTE or table, or None if they can't be resolved. """
+    if name not in ctes:
+        return conn.sql(f'select * from {name} limit 0').columns if conn is not None else None
+    select = ctes[name]
+    sources = _sources(select)
+    names = []
+    for proj in select.expressions:
+        star = _star(proj)
+        if star is None:
+            names.append(proj.alias_or_name)
+            continue
+        excluded = {c.name for c in star.args.get('except') or []}
+        tables = [sources.get(proj.table)] if isinstance(proj, exp.Column) else sources.values()
+        for table in tables:
+            sub = _output_names(table, ctes, conn) if table is not None else None
+            if sub is None:
+                return None
+            names += [n for n in sub if n not in excluded]
+    return names
+
+
+def _expand_stars(select: exp.Select, ctes: dict, conn: duckdb.DuckDBPyConnection = None):
+    """ Replaces resolvable `x.* exclude (...)` projections with explicit columns. """
+    sources = _sources(select)
+    projections = []
+    for proj in select.expressions:
+        star = _star(proj)
+        if isinstance(proj, exp.Column):
+            alias = proj.table
+        else:
+            alias = next(iter(sources)) if len(sources) == 1 else None
+        names = _output_names(sources[alias], ctes, conn) if alias in sources else None
+        if star is None or names is None:
+            projections.append(proj)
+            continue
+        excluded = {c.name for c in star.args.get('except') or []}
+        projections += [exp.column(n, table=alias) for n in names if n not in excluded]
+    select.set('expressions', projections)
+
+
+def _prune_projections(select: exp.Select, required):
+    """ Removes projections of select that aren't in required (None means keep everything). """
+    distinct = select.args.get('distinct')
+    if required is None or (distinct is not None and not distinct.args.get('on')):
+        return
+    group = select.args.get('group')
+    group_all = group is not None and group.args.get('all')
+    aliases = {p.alias_or_name for p in select.expressions}
+    keep = set(required)
+    while True:
+        kept = [
+            p for p in select.expressions
+            if _star(p) is not None or p.alias_or_name in keep
+            or (group_all and not _is_aggregate(p))
+        ]
+        # duckdb allows projections (and where/group/order clauses) to reference earlier aliases
+        clauses = kept + [
+            v for k, v in select.args.items() if k not in ('expressions', 'with') and v
+        ]
+        lateral = set()
+        for clause in clauses:
+            for node in clause if isinstance(clause, list) else [clause]:
+                if isinstance(node, exp.Expression):
+                    lateral |= {c.name for c in _columns(node) if not c.table} & aliases
+        if lateral <= keep:
+            break
+        keep |= lateral
+    select.set('expressions', kept or select.expressions[:1])
+
+
+def _prune_joins(select: exp.Select, top_level: bool):
+    """ Drops left joins whose columns are never referenced.
+
+    In the final select every joined CTE is keyed on the label columns (validate_feature_tables
+    checks this) so any unreferenced left join can go. Elsewhere only ASOF joins, which match at
+    most one row, are dropped.
+    """
+    joins = select.args.get('joins') or []
+    kept = []
+    for join in joins:
+        alias = join.this.alias_or_name
+        method = (join.method or '').upper()
+        if join.side.upper() == 'LEFT' and (top_level or method == 'ASOF'):
+            clauses = [j for j in joins if j is not join] + [
+                v for k, v in select.args.items() if k not in ('with', 'joins') and v
+            ]
+            nodes = [n for c in clauses for n in (c if isinstance(c, list) else [c])]
+            if not any(
+                isinstance(node, exp.Star) or any(c.table in (alias, '') for c in _columns(node))
+                for node in nodes if isinstance(node, exp.Expression)
+            ):
+                continue
+        kept.append(join)
+    select.set('joins', kept or None)
+
+
+def prune_query(query: str, keep_cols: list, conn: duckdb.DuckDBPyConnection = None) -> str:
+    """ Rewrites a rendered feats.sql query so it only computes the columns in keep_cols.
+
+    keep_cols should include the identifier and target columns. Walks the CTE dependency graph from
+    the final select backwards, removing unused projections, joins and whole CTEs whose outputs are
+    never consumed. If conn is given, it's used to resolve `select *` over base tables, which allows
+    pruning through them as well.
+    """
+    tree = sqlglot.parse_one(query, read='duckdb')
+    final = tree.expression if isinstance(tree, exp.Create) else tree
+    with_ = final.args.get('with')
+    cte_list = with_.expressions if with_ is not None else []
+    ctes = {cte.alias: cte.this for cte in cte_list}
+    required = {}
+    referenced_tables = set()
+    for name, select in [(None, final)] + [(c.alias, c.this) for c in reversed(cte_list)]:
+        if name is not None and name not in referenced_tables:
+            continue
+        _expand_stars(select, ctes, conn)
+        if name is None:
+            _prune_projections(select, keep_cols)
+        else:
+            needed = required.get(name, set())
+            _prune_projections(select, None if '*' in needed else needed)
+        _prune_joins(select, top_level=name is None)
+        sources = _sources(select)
+        for proj in select.expressions:
+            if _star(proj) is not None:
+                aliases = [proj.table] if isinstance(proj, exp.Column) else list(sources)
+                for alias in aliases:
+                    required.setdefault(sources.get(alias), set()).add('*')
+        for col in _columns(select):
+            tables = [sources.get(col.table)] if col.table else list(sources.values())
+            for table in tables:
+                required.setdefault(table, set()).add(col.name)
+        referenced_tables |= {
+            t.name for t in select.find_all(exp.Table)
+            if not any(isinstance(p, exp.With) for p in _parents(t, select))
+        }
+    if with_ is not None:
+        with_.set('expressions', [c for c in cte_list if c.alias in referenced_tables])
+    return to_duckdb_sql(tree, pretty=True)
+
+
+_WIDE_NUMERIC_TYPES = {
+    'DOUBLE', 'DECIMAL', 'BIGINT', 'INTEGER', 'SMALLINT', 'TINYINT', 'HUGEINT', 'UBIGINT',
+    'UINTEGER', 'USMALLINT', 'UTINYINT',
+}
+
+
+_ENUM_CATALOG = '_compact_types'
+
+
+def fetch_compact_df(
+    conn: duckdb.DuckDBPyConnection,
+    table_name: str,
+    col_to_stype: dict,
+    keep_dtype_cols: list = (),
+    enum_tables: list = None,
+    exclude_cols: list = (),
+    enum_prefix: str = None,
+) -> pd.DataFrame:
+    """ Reads a feature table into pandas with memory-compact dtypes.
+
+    Numerical columns are cast to float32 and boolean columns to uint8 in DuckDB. Text categorical
+    columns are dictionary-encoded as DuckDB ENUMs, which come out as pandas categoricals. The enum
+    types are built from the values in enum_tables (defaults to table_name), so pass all of the
+    train/val/test feature tables to get the same encoding for every split. The types are named
+    <enum_prefix>_<col>_enum (enum_prefix defaults to table_name, pass the task's table prefix):
+    fetching the first table of enum_tables (re)builds them, and the other tables reuse them rather
+    than scanning enum_tables again. Columns in keep_dtype_cols (eg: identifier and target columns)
+    and columns without an stype are read as is, while columns in exclude_cols aren't read at all.
+    """
+    enum_tables = enum_tables or [table_name]
+    enum_prefix = enum_prefix or table_name
+    # the ENUM types live in an in-memory catalog, so that reading features never writes to the
+    # database (which may also be read-only)
+    conn.sql(f"attach if not exists ':memory:' as {_ENUM_CATALOG}")
+    type_schema = f'{_ENUM_CATALOG}.main.'
+    existing_types = {
+        row[0] for row in conn.sql(
+            f"select type_name from duckdb_types() where database_name = '{_ENUM_CATALOG}'"
+        ).fetchall()
+    }
+    rebuild = table_name == enum_tables[0]
+    rel = conn.sql(f'select * from {table_name}')
+    select = []
+    for col, dtype in zip(rel.columns, rel.types):
+        dtype = str(dtype)
+        if col in exclude_cols:
+            continue
+        st = col_to_stype.get(col)
+        if col in keep_dtype_cols or st not in (stype.numerical, stype.categorical):
+            select.append(f'"{col}"')
+        elif dtype == 'BOOLEAN':
+            select.append(f'"{col}"::utinyint as "{col}"')
+        elif st == stype.numerical and dtype.split('(')[0] in _WIDE_NUMERIC_TYPES:
+            select.append(f'"{col}"::float as "{col}"')
+        elif st == stype.categorical and dtype == 'VARCHAR':
+            type_name = f'{enum_prefix}_{col}_enum'
+            enum_type = f'{type_schema}{type_name}'
+            if rebuild or type_name not in existing_types:
+                values = ' union '.join(f'select "{col}" as v from {t}' for t in enum_tables)
+                conn.sql(f'drop type if exists {enum_type}')
+                conn.sql(
+                    f'create type {enum_type} as enum '
+                    f'(select distinct v from ({values}) where v is not null order by v)'
+                )
+            select.append(f'"{col}"::{enum_type} as "{col}"')
+        else:
+            select.append(f'"{col}"')
+    df = conn.sql(f'select {", ".join(select)} from {table_name}').df()
+    # drop categories that only occur in other splits so category counts match the object dtype
+    for col in df.select_dtypes('category').columns:
+        df[col] = df[col].cat.remove_unused_categories()
+    return df
+
+
+# A column is categorical if its values appear more than this many times on average (mirrors the
+# min count threshold of torch_frame.utils.infer_df_stype).
+CAT_MIN_COUNT_THRESH = 4
+# Integer valued numeric columns with more distinct values than this are always numerical.
+CAT_MAX_NUMERIC_DISTINCT = 20
+
+
+def _infer_stype(dtype: str, count: int, n_distinct: int, integral: bool):
+    base = dtype.split('(')[0]
+    if base.startswith('TIMESTAMP') or base == 'DATE':
+        return stype.timestamp
+    if base == 'BOOLEAN':
+        return stype.categorical
+    if base in _WIDE_NUMERIC_TYPES or base == 'FLOAT':
+        if count == 0 or not integral:
+            return stype.numerical
+        if n_distinct <= CAT_MAX_NUMERIC_DISTINCT and count > CAT_MIN_COUNT_THRESH * n_distinct:
+            return stype.categorical
+        return stype.numerical
+    if base == 'VARCHAR':
+        if count > CAT_MIN_COUNT_THRESH * n_distinct:
+            return stype.categorical
+        return stype.text_embedded
+    return None
+
+
+def infer_stypes(
+    conn: duckdb.DuckDBPyConnection,
+    table_name: str,
+    overrides: dict = None,
+    cache_dir: str = None,
+) -> dict:
+    """ Infers a col_to_stype dict from the schema and column statistics of a feature table.
+
+    All statistics (non-null counts, approximate distinct counts and whether numeric columns are
+    integer valued) are computed in a single pass over the table. Results are cached in cache_dir,
+    keyed on a hash of the table schema. Entries in overrides (eg: the hand-maintained
+    inferred_stypes.task_to_stypes) take precedence for the columns that exist in the table.
+    """
+    rel = conn.sql(f'select * from {table_name} limit 0')
+    schema = [(c, str(t)) for c, t in zip(rel.columns, rel.types)]
+    cache_path = None
+    if cache_dir is not None:
+        schema_hash = hashlib.sha1(json.dumps([table_name, schema]).encode()).hexdigest()
+        cache_path = os.path.join(cache_dir, f'{schema_hash}.json')
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            inferred = {c: stype(v) for c, v in json.load(f).items()}
+    else:
+        aggs = []
+        for i, (col, dtype) in enumerate(schema):
+            aggs += [f'count("{col}") as n_{i}', f'approx_count_distinct("{col}") as d_{i}']
+            if dtype in ('DOUBLE', 'FLOAT') or dtype.startswith('DECIMAL'):
+                aggs.append(
+                    f'coalesce(bool_and("{col}" = round("{col}")) '
+                    f'filter (where isfinite("{col}"::double)), true) as i_{i}'
+                )
+            else:
+                aggs.append(f'true as i_{i}')
+        stats = conn.sql(f'select {", ".join(aggs)} from {table_name}').fetchone()
+        inferred = {}
+        for i, (col, dtype) in enumerate(schema):
+            st = _infer_stype(dtype, *stats[3 * i:3 * i + 3])
+            if st is not None:
+                inferred[col] = st
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path, 'w') as f:
+                json.dump({c: st.value for c, st in inferred.items()}, f, indent=2)
+    for col, st in (overrides or {}).items():
+        if col in inferred or col in rel.columns:
+            inferred[col] = st
+    return inferred
+
+
+def validate_stypes(
+    conn: duckdb.DuckDBPyConnection, table_name: str, col_to_stype: dict, ignore_cols: list = ()
+):
+    """ Raises a ValueError if col_to_stype has columns that are missing from table_name, and
+    returns the columns of the table without an stype (with a warning) for the caller to drop. """
+    columns = conn.sql(f'select * from {table_name} limit 0').columns
+    missing = [c for c in col_to_stype if c not in columns and c not in ignore_cols]
+    untyped = [c for c in columns if c not in col_to_stype and c not in ignore_cols]
+    if missing:
+        # torch_frame matches stypes to columns by exact name, so case-only mismatches are errors
+        by_lower = {c.lower(): c for c in untyped}
+        case_only = {c: by_lower[c.lower()] for c in missing if c.lower() in by_lower}
+        raise ValueError(
+            f'stypes don\'t match the schema of {table_name}. '
+            f'Columns with an stype but missing from the table: {missing}.'
+            + (f' These differ from table columns only in case: {case_only}.' if case_only else '')
+        )
+    if untyped:
+        print(f'Warning: dropping columns of {table_name} without an stype: {untyped}')
+    return untyped
 
 
 def validate_feature_tables(
@@ -123,3 +920,53 @@ def feature_summary_df(df: pd.DataFrame, y_col: str, classification: bool = True
         .style
         .format({'Label Corr.': '{:.3f}', 'Label MI': '{:.3f}', 'NaN %': '{:.1%}'})
     )
+
+
+def evaluate_preds(
+    conn: duckdb.DuckDBPyConnection,
+    label_table: str,
+    ids_df: pd.DataFrame,
+    preds,
+    identifier_cols: list,
+    target_col: str,
+    classification: bool = True,
+) -> dict:
+    """ Evaluates predictions against a label table of the database, without relbench.
+
+    preds[i] is the prediction for the label row identified by row i of ids_df[identifier_cols]
+    (eg: the rows of a feature table, in whatever order it was generated). Predictions are aligned
+    to the labels with a join in DuckDB, and the metrics are those relbench reports for the task
+    type: average_precision, accuracy, f1 and roc_auc (at a 0.5 threshold) for binary
+    classification, and r2, mae and rmse for regression.
+    """
+    preds_df = ids_df[identifier_cols].assign(_pred=preds)  # noqa
+    on = ' and '.join(f'labels."{c}" = preds."{c}"' for c in identifier_cols)
+    aligned = conn.sql(f"""
+        select
+            labels."{target_col}" as target,
+            preds._pred as pred
+        from {label_table} as labels
+        left join preds_df as preds
+            on {on}
+    """).df()
+    num_labels, = conn.sql(f'select count(*) from {label_table}').fetchone()
+    missing = aligned['pred'].isna().sum()
+    if len(aligned) != num_labels or len(preds_df) != num_labels or missing > 0:
+        raise ValueError(
+            f'Predictions don\'t match the rows of {label_table}: {len(preds_df):,} predictions, '
+            f'{num_labels:,} labels, {missing:,} labels without a prediction.'
+        )
+    target, pred = aligned['target'].to_numpy(), aligned['pred'].to_numpy()
+    if classification:
+        label = pred > 0.5
+        return {
+            'average_precision': metrics.average_precision_score(target, pred),
+            'accuracy': metrics.accuracy_score(target, label),
+            'f1': metrics.f1_score(target, label, average='binary'),
+            'roc_auc': metrics.roc_auc_score(target, pred),
+        }
+    return {
+        'r2': metrics.r2_score(target, pred),
+        'mae': metrics.mean_absolute_error(target, pred),
+        'rmse': metrics.mean_squared_error(target, pred) ** 0.5,
+    }